@@ -0,0 +1,43 @@
+from normalize import artistKey, songKey
+from playIndex import PlayIndex
+
+
+PIVOTS = ('artist', 'track')
+
+
+def groupPivots(catalog, pivots=PIVOTS):
+    # {pivot: {group: {'plays': unique airdates, 'songs': set of (artist,
+    # track)}}} for each of `pivots`, from one pass over the plays.
+    index = PlayIndex.fromPlays(catalog)
+    built = index.pivots()
+    return dict((p, index.groups(p, built)) for p in pivots)
+
+
+def groupKey(pivot, name, group):
+    # The normalize key two groups from different days share if they are
+    # the same artist or track under different spellings.
+    if pivot == 'track':
+        return songKey(*next(iter(group['songs'])))
+    return artistKey(name)
+
+
+def mergeGroups(result, groups, pivot='artist', names=None):
+    # Folds one set of groups (eg a single day's) into `result` in place.
+    # Groups are matched by groupKey and keep the name `result` already
+    # has for them. Play counts are added: a play's airdate falls in one
+    # day only, so groups from different days never share a play.
+    # `names` ({groupKey: name} of `result`) is built when not given; pass
+    # the same dict in when merging many days, it is kept up to date.
+    if names is None:
+        names = dict((groupKey(pivot, name, group), name)
+                     for name, group in result.items())
+    for name, group in groups.items():
+        # a name already in `result` is its own group's name; only new
+        # spellings need their key
+        if name not in result:
+            name = names.setdefault(groupKey(pivot, name, group), name)
+        if name not in result:
+            result[name] = {'plays': 0, 'songs': set()}
+        result[name]['plays'] += group['plays']
+        result[name]['songs'] |= group['songs']
+    return result
@@ -0,0 +1,106 @@
+import argparse
+import datetime
+import json
+import sys
+import time
+
+from catalogStore import CatalogStore
+from kexpFetch import Fetcher, formatDate, hourRange
+from metrics import metrics
+from processCatalog import setEnvironment, uprint
+
+# Fills the catalog store with history, eg for plotChart.plotTop40:
+#
+#   python backfill.py --from 2024-01-01 --to 2024-12-31
+#
+# Every hour is written to the store as soon as it is downloaded, and the
+# store's hour table is the checkpoint: a killed backfill picks up with
+# the hours that are still missing. All requests share the fetcher's one
+# rate limit (requestsPerSecond in the config).
+
+
+def parseDay(value):
+    return datetime.datetime.strptime(value, "%Y-%m-%d")
+
+
+def chunked(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def backfill(config, first, last, chunkDays=7, log=uprint):
+    # Fetches every missing hour of the days first..last (inclusive), a
+    # chunk of `chunkDays` days at a time. Returns the hours that failed.
+    days = []
+    day = first
+    while day <= last:
+        days.append(day)
+        day += datetime.timedelta(days=1)
+
+    store = CatalogStore.fromConfig(config)
+    for day in store.importJsonCache():
+        log("Imported cache/{}.json".format(day.strftime("%Y%m%d")))
+    todo = [h for d in days for h in store.missingHours(d)]
+    log("Backfilling {} to {}: {} of {} hours to fetch".format(
+        first.strftime("%Y-%m-%d"), last.strftime("%Y-%m-%d"),
+        len(todo), 24 * len(days)))
+
+    started = time.monotonic()
+    fetched = 0
+    plays = 0
+    failed = []
+    with Fetcher.fromConfig(config) as fetcher:
+        for chunk in chunked(todo, 24 * chunkDays):
+            for start, end, tracks, err in fetcher.iterWindows(
+                    chunk, store.hourDensity(now=chunk[0]), 24 * chunkDays):
+                if err is not None:
+                    log(err)
+                    failed += hourRange(start, end)
+                    continue
+                store.storeRange(start, end, tracks)
+                fetched += len(hourRange(start, end))
+                plays += len(tracks)
+            elapsed = max(time.monotonic() - started, 1e-9)
+            remaining = len(todo) - fetched - len(failed)
+            log("{} .. {}: {}/{} hours, {} plays, {:.1f} plays/s, "
+                "{:.1f} hours/s, ~{:.0f}s left".format(
+                    formatDate(chunk[0]), formatDate(chunk[-1]),
+                    fetched, len(todo), plays, plays / elapsed,
+                    fetched / elapsed,
+                    remaining / max(fetched / elapsed, 1e-9)))
+    store.close()
+    metrics.count('backfill.hours', fetched)
+    metrics.count('backfill.plays', plays)
+    return failed
+
+
+def parseArgs():
+    parser = argparse.ArgumentParser(
+        'Backfill the KEXP catalog store over a date range')
+    parser.add_argument('--config', type=str, default='config.json',
+                        help='Config file in json format')
+    parser.add_argument('--from', dest='first', type=parseDay, required=True,
+                        help='First day to fetch, YYYY-MM-DD')
+    parser.add_argument('--to', dest='last', type=parseDay, required=True,
+                        help='Last day to fetch (inclusive), YYYY-MM-DD')
+    parser.add_argument('--chunk-days', type=int, default=7,
+                        help='Days per chunk between progress reports')
+    return parser.parse_args()
+
+
+def main():
+    args = parseArgs()
+    with open(args.config, 'r', encoding='utf-8') as inCfg:
+        config = json.load(inCfg)
+
+    setEnvironment(config)
+    with metrics.stage('backfill'):
+        failed = backfill(config, args.first, args.last, args.chunk_days)
+    if len(failed) > 0:
+        uprint("Failed to fetch {} hour(s); rerun to retry them".format(
+            len(failed)))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,507 @@
+import argparse
+import datetime
+import hashlib
+import json
+import os
+import random
+import re
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+# End-to-end benchmark for processCatalog.main against local stand-ins for
+# legacy-api.kexp.org and the Spotify Web API. Each scenario runs main twice
+# in a fresh working directory, cold (empty cache/) then warm, in a child
+# process so memory and start-up are measured like a real run.
+#
+#   python benchmark.py --days 7 14 90
+#   python benchmark.py --days 14 --rate-limit-every 25 --check
+#
+# Results are appended to benchmarks.json; --check compares against the
+# previous run of each scenario and exits non-zero on a regression.
+
+PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+ARTISTS = 400
+PLAYLIST_ID = 'benchPlaylist0000000001'
+BASE62 = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz'
+
+
+def base62Id(text):
+    n = int(hashlib.md5(text.encode('utf-8')).hexdigest(), 16)
+    out = ''
+    for _ in range(22):
+        n, r = divmod(n, 62)
+        out += BASE62[r]
+    return out
+
+
+def parseDate(value):
+    return datetime.datetime.strptime(value, "%Y-%m-%dT%H:%M:%SZ")
+
+
+def syntheticHour(start):
+    # Deterministic plays for one hour: skewed artist popularity, a few
+    # air breaks (no artist/track) and the odd duplicate airdate.
+    rng = random.Random(int(start.timestamp()))
+    plays = []
+    t = start
+    while True:
+        t += datetime.timedelta(seconds=rng.randint(150, 330))
+        if t >= start + datetime.timedelta(hours=1):
+            break
+        airdate = t.strftime("%Y-%m-%dT%H:%M:%SZ")
+        if rng.random() < 0.05:
+            plays.append({'airdate': airdate, 'artist': None,
+                          'track': None, 'playtype': {'name': 'Air break'}})
+            continue
+        a = int(ARTISTS * rng.random() ** 3)
+        play = {
+            'airdate': airdate,
+            'artist': {'artistid': a, 'name': 'Artist {}'.format(a)},
+            'track': {'name': 'Song {} of Artist {}'.format(
+                rng.randint(0, 4), a)},
+            'release': {'name': 'Release {}'.format(a),
+                        'largeimageuri': 'https://example.org/' + 'x' * 60},
+            'label': {'name': 'Label {}'.format(a % 37)},
+            'show': {'showid': start.hour, 'program': {'name': 'Show'}},
+            'playtype': {'name': 'Media play'}}
+        plays.append(play)
+        if rng.random() < 0.02:
+            plays.append(dict(play))
+    return plays
+
+
+class StandIn(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, handler, latency):
+        super().__init__(('127.0.0.1', 0), handler)
+        self.latency = latency
+        self.counts = Counter()
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}'.format(self.server_port)
+
+    def count(self, key, n=1):
+        with self.lock:
+            self.counts[key] += n
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+class Handler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def reply(self, body, status=200, headers=None):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return json.loads(self.rfile.read(length) or b'null')
+
+
+class KexpHandler(Handler):
+    # /play?begin_time=&end_time=&ordering=airdate[&limit=][&offset=]
+    def do_GET(self):
+        time.sleep(self.server.latency)
+        url = urlparse(self.path)
+        if url.path != '/play':
+            return self.reply({'detail': 'Not found.'}, 404)
+        q = parse_qs(url.query)
+        begin = parseDate(q['begin_time'][0])
+        end = parseDate(q['end_time'][0])
+        offset = int(q.get('offset', ['0'])[0])
+        limit = min(int(q.get('limit', [PAGE_SIZE])[0]), MAX_PAGE_SIZE)
+        self.server.count('requests')
+        if offset == 0:
+            self.server.count('windows')
+        plays = []
+        hour = begin.replace(minute=0, second=0)
+        while hour < end:
+            plays += [p for p in syntheticHour(hour)
+                      if q['begin_time'][0] <= p['airdate'] <
+                      q['end_time'][0]]
+            hour += datetime.timedelta(hours=1)
+        page = plays[offset:offset + limit]
+        nextUrl = None
+        if offset + limit < len(plays):
+            nextUrl = '{}/play?begin_time={}&end_time={}&ordering=airdate' \
+                '&limit={}&offset={}'.format(
+                    self.server.url, q['begin_time'][0], q['end_time'][0],
+                    limit, offset + limit)
+        self.reply({'results': page, 'next': nextUrl})
+
+
+class SpotifyStandIn(StandIn):
+    def __init__(self, handler, latency, rateLimitEvery=0, retryAfter=1):
+        super().__init__(handler, latency)
+        self.rateLimitEvery = rateLimitEvery
+        self.retryAfter = retryAfter
+        self.playlist = []
+        self.snapshot = 0
+        self.decoys = set()
+
+    def edit(self, change):
+        with self.lock:
+            change(self.playlist)
+            self.snapshot += 1
+            return {'snapshot_id': 'snap{}'.format(self.snapshot)}
+
+
+class SpotifyHandler(Handler):
+    def route(self):
+        time.sleep(self.server.latency)
+        url = urlparse(self.path)
+        parts = url.path.strip('/').split('/')[1:]
+        return parts, parse_qs(url.query)
+
+    def do_GET(self):
+        parts, q = self.route()
+        s = self.server
+        if parts == ['search']:
+            s.count('search')
+            if s.rateLimitEvery and s.counts['search'] % s.rateLimitEvery == 0:
+                s.count('429')
+                return self.reply({'error': {'status': 429}}, 429,
+                                  {'Retry-After': str(s.retryAfter)})
+            return self.reply({'tracks': {'items': self.search(
+                q['q'][0], int(q.get('limit', ['10'])[0]))}})
+        s.count('playlist_reads')
+        if parts[0] == 'users':
+            return self.reply({'items': [{'name': 'KEXP Bench',
+                                          'id': PLAYLIST_ID}], 'next': None})
+        if len(parts) == 2:
+            return self.reply({'id': PLAYLIST_ID, 'name': 'KEXP Bench',
+                               'snapshot_id': 'snap{}'.format(s.snapshot)})
+        offset = int(q.get('offset', ['0'])[0])
+        limit = int(q.get('limit', ['100'])[0])
+        items = s.playlist[offset:offset + limit]
+        nextUrl = None
+        if offset + limit < len(s.playlist):
+            nextUrl = '{}/v1/playlists/{}/items?offset={}&limit={}'.format(
+                s.url, PLAYLIST_ID, offset + limit, limit)
+        self.reply({'items': [{'track': {'uri': u}} for u in items],
+                    'next': nextUrl})
+
+    def search(self, query, limit):
+        # Exact queries miss one time in ten. Keyword queries for the
+        # synthetic "Artist N Song K of Artist N" return the track among
+        # same-artist and cover decoys, miss one time in twenty and return
+        # only the decoys one time in twenty. The decoys' ids are kept so a
+        # run can count how many of them made it into the playlist.
+        h = int(hashlib.md5(query.encode('utf-8')).hexdigest(), 16)
+        if query.startswith('artist:'):
+            if h % 10 == 0:
+                return []
+            artist, track = query[len('artist:'):].split(' track:', 1)
+            return [{'id': base62Id(artist + '|' + track), 'name': track,
+                     'artists': [{'name': artist}]}]
+        if h % 20 == 0:
+            return []
+        m = re.match(r'(Artist \d+) (Song (\d+) of Artist \d+)$', query)
+        if m is None:
+            return [{'id': base62Id('Keyword|' + query), 'name': query,
+                     'artists': [{'name': 'Keyword'}]}]
+        artist, track, k = m.group(1), m.group(2), int(m.group(3))
+        items = [{'id': base62Id('Cover|' + track), 'name': track,
+                  'artists': [{'name': 'Cover Band'}]}]
+        items += [{'id': base62Id('{}|Song {}'.format(artist, j)),
+                   'name': 'Song {} of {}'.format(j, artist),
+                   'artists': [{'name': artist}]}
+                  for j in range(5) if j != k]
+        with self.server.lock:
+            self.server.decoys.update(item['id'] for item in items)
+        if h % 20 == 1:
+            return items[:limit]
+        items.insert(h % (len(items) + 1),
+                     {'id': base62Id(artist + '|' + track),
+                      'name': track + ' - Remastered',
+                      'artists': [{'name': artist}]})
+        return items[:limit]
+
+    def do_POST(self):
+        parts, q = self.route()
+        self.server.count('playlist_writes')
+        body = self.body()
+        uris = body['uris'] if isinstance(body, dict) else body
+        position = int(q['position'][0]) if 'position' in q else None
+
+        def add(pl):
+            at = len(pl) if position is None else position
+            pl[at:at] = uris
+        self.reply(self.server.edit(add), 201)
+
+    def do_PUT(self):
+        parts, q = self.route()
+        self.server.count('playlist_writes')
+        body = self.body()
+        if len(parts) == 2:
+            return self.reply({})
+        if 'uris' in body:
+            def replace(pl):
+                pl[:] = body['uris']
+            return self.reply(self.server.edit(replace))
+
+        def reorder(pl):
+            start = body['range_start']
+            length = body.get('range_length', 1)
+            before = body['insert_before']
+            moved = pl[start:start + length]
+            del pl[start:start + length]
+            if before > start:
+                before -= length
+            pl[before:before] = moved
+        self.reply(self.server.edit(reorder))
+
+    def do_DELETE(self):
+        parts, q = self.route()
+        self.server.count('playlist_writes')
+        body = self.body()
+        positions = sorted((p for item in body.get('items',
+                                                   body.get('tracks', []))
+                            for p in item['positions']), reverse=True)
+
+        def remove(pl):
+            for p in positions:
+                del pl[p]
+        self.reply(self.server.edit(remove))
+
+
+def reportChild(tag, run):
+    # Calls `run` with its output silenced and prints one line starting
+    # with `tag`: wall clock, peak memory of this process, what `run`
+    # returned and the metrics summary. Shared with scaleBench.py.
+    from metrics import metrics
+
+    out = sys.stdout
+    start = time.perf_counter()
+    with open(os.devnull, 'w', encoding='utf-8') as devnull:
+        sys.stdout = devnull
+        try:
+            result = run()
+        finally:
+            sys.stdout = out
+    print(tag + ' ' + json.dumps({
+        'wall': time.perf_counter() - start,
+        'maxrss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'result': result,
+        'metrics': metrics.summary()}))
+
+
+def runChildProcess(script, childArgs, workdir, tag):
+    # Runs `script --child <childArgs>` in `workdir` and returns the
+    # report its reportChild(tag, ...) printed.
+    proc = subprocess.run(
+        [sys.executable, os.path.abspath(script), '--child'] + childArgs,
+        cwd=workdir, capture_output=True, text=True)
+    if proc.returncode != 0:
+        sys.stderr.write(proc.stderr)
+        raise RuntimeError('{} child failed: {}'.format(
+            os.path.basename(script), ' '.join(childArgs)))
+    return json.loads([line for line in proc.stdout.splitlines()
+                       if line.startswith(tag + ' ')][-1][len(tag) + 1:])
+
+
+def recordRun(path, params, scenarios, check, tolerance):
+    # Appends this run to the history in `path` and prints the problems
+    # check(previous, scenarios, tolerance) finds, where `previous` maps
+    # days to the scenario of the latest earlier run with the same
+    # parameters. Returns the problems. Shared with scaleBench.py.
+    history = []
+    if os.path.exists(path):
+        with open(path, 'r', encoding='utf-8') as inResults:
+            history = json.load(inResults)
+    previous = {}
+    for entry in history:
+        if entry['params'] == params:
+            for s in entry['scenarios']:
+                previous[s['days']] = s
+    problems = check(previous, scenarios, tolerance)
+    history.append({'date': datetime.datetime.utcnow().isoformat(),
+                    'params': params, 'scenarios': scenarios})
+    with open(path, 'w', encoding='utf-8') as outResults:
+        json.dump(history, outResults, indent=1)
+
+    for p in problems:
+        print('REGRESSION ' + p)
+    return problems
+
+
+def runChild(configPath):
+    # Runs processCatalog.main in this process and prints one BENCH line.
+    import logging
+    import processCatalog
+
+    logging.getLogger('spotipy').setLevel(logging.CRITICAL)
+    sys.argv = ['processCatalog.py', '--config', configPath,
+                '--metrics', os.devnull]
+    reportChild('BENCH', processCatalog.main)
+
+
+def runOnce(workdir, configPath, kexp, spotify):
+    before = (Counter(kexp.counts), Counter(spotify.counts))
+    start = time.perf_counter()
+    child = runChildProcess(__file__, [configPath], workdir, 'BENCH')
+    elapsed = time.perf_counter() - start
+    kexpCounts = kexp.counts - before[0]
+    spotifyCounts = spotify.counts - before[1]
+    return {
+        'wall': round(child['wall'], 3),
+        'process_wall': round(elapsed, 3),
+        'maxrss_kb': child['maxrss_kb'],
+        'kexp_requests': kexpCounts['requests'],
+        'kexp_windows': kexpCounts['windows'],
+        'spotify_search': spotifyCounts['search'],
+        'spotify_429': spotifyCounts['429'],
+        'spotify_playlist_reads': spotifyCounts['playlist_reads'],
+        'spotify_playlist_writes': spotifyCounts['playlist_writes'],
+        'spotify_wrong_matches': sum(
+            1 for uri in spotify.playlist
+            if uri.split(':')[-1] in spotify.decoys),
+        'kexp_cache_hit_rate': child['metrics']['cache']['kexp_hit_rate'],
+        'resolve_cache_hit_rate':
+            child['metrics']['cache']['search_hit_rate'],
+        'stages': child['metrics']['stages'],
+    }
+
+
+def runScenario(days, args, kexp, spotify):
+    workdir = tempfile.mkdtemp(prefix='kexp-bench-')
+    config = {
+        'spotify_username': 'bench',
+        'playlist_name': 'KEXP Bench',
+        'spotifyAccessToken': 'bench',
+        'spotifyApiPrefix': spotify.url + '/v1/',
+        'kexpBaseUrl': kexp.url,
+        'requestsPerSecond': args.kexp_rps,
+        'daysToParse': days,
+        'topN': args.top_n,
+        'pivot': args.pivot,
+    }
+    configPath = os.path.join(workdir, 'config.json')
+    with open(configPath, 'w', encoding='utf-8') as outCfg:
+        json.dump(config, outCfg)
+
+    scenario = {'days': days}
+    for phase in ('cold', 'warm'):
+        scenario[phase] = runOnce(workdir, configPath, kexp, spotify)
+    return scenario
+
+
+def checkRegressions(previous, scenarios, tolerance):
+    # Compares each scenario with the latest earlier run that used the
+    # same parameters. Request counts must not grow; time and memory may
+    # grow by `tolerance`.
+    problems = []
+    for s in scenarios:
+        for phase in ('cold', 'warm'):
+            if s[phase].get('spotify_wrong_matches'):
+                problems.append('{}d {} spotify_wrong_matches: {}'.format(
+                    s['days'], phase, s[phase]['spotify_wrong_matches']))
+        old = previous.get(s['days'])
+        if old is None:
+            continue
+        for phase in ('cold', 'warm'):
+            for key in ('kexp_requests', 'spotify_search',
+                        'spotify_playlist_writes'):
+                if s[phase][key] > old[phase][key]:
+                    problems.append('{}d {} {}: {} -> {}'.format(
+                        s['days'], phase, key, old[phase][key],
+                        s[phase][key]))
+            for key in ('wall', 'maxrss_kb'):
+                if s[phase][key] > old[phase][key] * (1 + tolerance):
+                    problems.append('{}d {} {}: {} -> {}'.format(
+                        s['days'], phase, key, old[phase][key],
+                        s[phase][key]))
+    return problems
+
+
+def printScenario(s):
+    for phase in ('cold', 'warm'):
+        r = s[phase]
+        print('{:>4}d {:<4} {:8.2f}s {:7d} KB  kexp {:5d} req ({} hit)  '
+              'search {:4d} ({} 429, {} hit)  playlist {}r/{}w  '
+              '{} wrong'.format(
+                  s['days'], phase, r['wall'], r['maxrss_kb'],
+                  r['kexp_requests'], r['kexp_cache_hit_rate'],
+                  r['spotify_search'], r['spotify_429'],
+                  r['resolve_cache_hit_rate'],
+                  r['spotify_playlist_reads'], r['spotify_playlist_writes'],
+                  r.get('spotify_wrong_matches')))
+
+
+def parseArgs():
+    parser = argparse.ArgumentParser(
+        'Benchmark processCatalog against local KEXP/Spotify stand-ins')
+    parser.add_argument('--days', type=int, nargs='+', default=[7, 14, 90],
+                        help='Window sizes to run, one scenario each')
+    parser.add_argument('--kexp-latency', type=float, default=0.05,
+                        help='Seconds added to every KEXP response')
+    parser.add_argument('--spotify-latency', type=float, default=0.02,
+                        help='Seconds added to every Spotify response')
+    parser.add_argument('--rate-limit-every', type=int, default=0,
+                        help='Answer every Nth search with a 429')
+    parser.add_argument('--retry-after', type=int, default=1,
+                        help='Retry-After seconds sent with injected 429s')
+    parser.add_argument('--kexp-rps', type=float, default=50,
+                        help='requestsPerSecond for the KEXP fetcher')
+    parser.add_argument('--top-n', type=int, default=100)
+    parser.add_argument('--pivot', type=str, default='track')
+    parser.add_argument('--results', type=str, default='benchmarks.json',
+                        help='File the results are appended to')
+    parser.add_argument('--check', action='store_true',
+                        help='Exit non-zero if a scenario regressed')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='Allowed relative growth in time and memory')
+    parser.add_argument('--child', type=str, help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+def main():
+    args = parseArgs()
+    if args.child:
+        runChild(args.child)
+        return
+
+    params = {k: getattr(args, k) for k in (
+        'kexp_latency', 'spotify_latency', 'rate_limit_every', 'retry_after',
+        'kexp_rps', 'top_n', 'pivot')}
+    kexp = StandIn(KexpHandler, args.kexp_latency).start()
+    spotify = SpotifyStandIn(SpotifyHandler, args.spotify_latency,
+                             args.rate_limit_every, args.retry_after).start()
+
+    scenarios = []
+    for days in args.days:
+        # each scenario gets a fresh playlist as well as a fresh cache
+        spotify.playlist = []
+        scenario = runScenario(days, args, kexp, spotify)
+        printScenario(scenario)
+        scenarios.append(scenario)
+
+    problems = recordRun(args.results, params, scenarios, checkRegressions,
+                         args.tolerance)
+    if args.check and len(problems) > 0:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,321 @@
+import datetime
+import glob
+import json
+import os
+import sqlite3
+import time
+import zlib
+
+from aggregate import groupPivots, mergeGroups
+from kexpFetch import formatDate
+
+
+def dayKey(day):
+    return day.strftime("%Y-%m-%d")
+
+
+def hourKey(hour):
+    # Same prefix as the airdate strings, so hours sort and compare with them.
+    return hour.strftime("%Y-%m-%dT%H")
+
+
+def epoch(naive):
+    # Dates here are naive UTC.
+    return naive.replace(tzinfo=datetime.timezone.utc).timestamp()
+
+
+class CatalogStore:
+    # Single indexed store for KEXP plays, replacing the per-day JSON dumps
+    # in cache/. Plays are projected at ingest to the three fields we use
+    # (airdate, artist name, track name), with the names interned into a
+    # `names` table so each play row is an airdate and two integers, and
+    # plays are indexed by airdate, so loading a window is one range scan.
+    # The full KEXP records are only kept when keepRaw is set, zlib
+    # compressed one hour per row in a side database (`rawPath`) that is
+    # opened and decoded only when loadRaw asks for it.
+    #
+    # Plays are written one UTC hour at a time, each hour in its own
+    # transaction together with its row in `hours`, so an interrupted fetch
+    # keeps every hour it finished. An hour only counts as complete if it
+    # was fetched at least `settle` seconds after it ended; anything fetched
+    # earlier (a day cached while still on air) is fetched again.
+    def __init__(self, path='cache/catalog.sqlite', keepRaw=False,
+                 settle=3600, rawPath=None):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.keepRaw = keepRaw
+        self.settle = settle
+        self.rawPath = rawPath if rawPath is not None else \
+            os.path.splitext(path)[0] + '-raw.sqlite'
+        self.raw = None
+        self.db = sqlite3.connect(path)
+        self.db.executescript(
+            'CREATE TABLE IF NOT EXISTS names ('
+            ' id INTEGER PRIMARY KEY,'
+            ' name TEXT UNIQUE NOT NULL);'
+            'CREATE TABLE IF NOT EXISTS plays ('
+            ' airdate TEXT NOT NULL,'
+            ' artist INTEGER,'
+            ' track INTEGER);'
+            'CREATE INDEX IF NOT EXISTS plays_airdate ON plays (airdate);'
+            'CREATE TABLE IF NOT EXISTS hours ('
+            ' hour TEXT PRIMARY KEY,'
+            ' plays INTEGER NOT NULL,'
+            ' fetched_at REAL NOT NULL);'
+            'CREATE TABLE IF NOT EXISTS day_summaries ('
+            ' day TEXT NOT NULL,'
+            ' pivot TEXT NOT NULL,'
+            ' groups TEXT NOT NULL,'
+            ' PRIMARY KEY (day, pivot));')
+        self.db.commit()
+        self.loadNames()
+
+    @classmethod
+    def fromConfig(cls, config):
+        return cls(config.get('catalogStore', 'cache/catalog.sqlite'),
+                   config.get('keepRawPlays', False),
+                   config.get('settleSeconds', 3600),
+                   config.get('rawStore'))
+
+    def close(self):
+        self.db.close()
+        if self.raw is not None:
+            self.raw.close()
+
+    def rawDb(self, create=True):
+        # The side database of raw records, opened on first use.
+        if self.raw is None:
+            if not create and not os.path.exists(self.rawPath):
+                return None
+            self.raw = sqlite3.connect(self.rawPath)
+            self.raw.execute(
+                'CREATE TABLE IF NOT EXISTS raw_hours ('
+                ' hour TEXT PRIMARY KEY,'
+                ' records BLOB NOT NULL)')
+        return self.raw
+
+    def storeRaw(self, hours):
+        # hours: {hour key: [raw KEXP records]}, replacing each hour's row.
+        db = self.rawDb()
+        with db:
+            db.executemany(
+                'INSERT OR REPLACE INTO raw_hours VALUES (?,?)',
+                [(k, zlib.compress(json.dumps(v).encode('utf-8')))
+                 for k, v in hours.items()])
+
+    def loadNames(self):
+        # id <-> name, kept in memory; names are never deleted.
+        self.names = dict(self.db.execute('SELECT id, name FROM names'))
+        self.nameIds = dict((n, i) for i, n in self.names.items())
+
+    def nameId(self, name):
+        # Interns `name`; must be called inside the write transaction.
+        if name is None:
+            return None
+        i = self.nameIds.get(name)
+        if i is None:
+            i = self.db.execute('INSERT INTO names (name) VALUES (?)',
+                                (name,)).lastrowid
+            self.nameIds[name] = i
+            self.names[i] = name
+        return i
+
+    def missingHours(self, day, now=None):
+        # Hour starts of `day` that were never fetched, or were fetched too
+        # soon after they aired to be trusted.
+        now = time.time() if now is None else now
+        fetched = dict(self.db.execute(
+            'SELECT hour, fetched_at FROM hours WHERE hour >= ? AND hour < ?',
+            (hourKey(day), hourKey(day + datetime.timedelta(days=1)))))
+        missing = []
+        for h in range(24):
+            start = day + datetime.timedelta(hours=h)
+            end = start + datetime.timedelta(hours=1)
+            fetchedAt = fetched.get(hourKey(start))
+            if fetchedAt is None or \
+                    fetchedAt < epoch(end) + self.settle:
+                missing.append(start)
+        return missing
+
+    def hasDay(self, day):
+        return len(self.missingHours(day)) == 0
+
+    def knownDay(self, day):
+        return self.db.execute(
+            'SELECT 1 FROM hours WHERE hour >= ? AND hour < ? LIMIT 1',
+            (hourKey(day), hourKey(day + datetime.timedelta(days=1)))
+        ).fetchone() is not None
+
+    def daySignatures(self):
+        # {day: (hours stored, plays, last fetched_at)} for every day with
+        # any stored hour; a day whose signature changes was re-stored.
+        return dict(
+            (datetime.datetime.strptime(day, "%Y-%m-%d"), (n, plays, last))
+            for day, n, plays, last in self.db.execute(
+                'SELECT substr(hour, 1, 10), COUNT(*), SUM(plays),'
+                ' MAX(fetched_at) FROM hours GROUP BY 1'))
+
+    def hourDensity(self, days=28, now=None):
+        # Average stored plays per hour of day (0-23) over the `days` days
+        # before `now`, which the fetcher plans its request windows from.
+        # Empty hours (and days imported without hour counts) are left out.
+        now = datetime.datetime.utcnow() if now is None else now
+        return dict(self.db.execute(
+            'SELECT CAST(substr(hour, 12, 2) AS INTEGER), AVG(plays)'
+            ' FROM hours WHERE hour >= ? AND hour < ? AND plays > 0'
+            ' GROUP BY 1',
+            (hourKey(now - datetime.timedelta(days=days)), hourKey(now))))
+
+    def addHour(self, start, plays, fetchedAt=None):
+        # Replaces whatever was stored for the hour at `start` and marks it
+        # fetched, in one transaction.
+        self.storeRange(start, start + datetime.timedelta(hours=1), plays,
+                        fetchedAt)
+
+    def addDay(self, day, plays, fetchedAt=None):
+        self.storeRange(day, day + datetime.timedelta(days=1), plays,
+                        fetchedAt)
+
+    def storeRange(self, start, end, plays, fetchedAt=None):
+        fetchedAt = time.time() if fetchedAt is None else fetchedAt
+        hours = []
+        h = start
+        while h < end:
+            hours.append(h)
+            h += datetime.timedelta(hours=1)
+        counts = dict((hourKey(h), 0) for h in hours)
+        begin = formatDate(start)
+        until = formatDate(end)
+        kept = []
+        raw = dict((k, []) for k in counts) if self.keepRaw else None
+        for p in plays:
+            # the range is replaced wholesale below, so anything the API
+            # returned outside it would never be cleaned up again
+            if not begin <= p['airdate'] < until:
+                continue
+            kept.append(p)
+            key = p['airdate'][:len('YYYY-MM-DDTHH')]
+            if key in counts:
+                counts[key] += 1
+                if raw is not None:
+                    raw[key].append(p)
+        days = set(dayKey(h) for h in hours)
+        try:
+            self.writeRange(begin, until, kept, counts, days, fetchedAt)
+        except Exception:
+            # names interned by the rolled back transaction are gone
+            self.loadNames()
+            raise
+        if raw is not None:
+            self.storeRaw(raw)
+
+    def writeRange(self, begin, until, plays, counts, days, fetchedAt):
+        with self.db:
+            rows = []
+            for p in plays:
+                artist = p.get('artist')
+                track = p.get('track')
+                rows.append((
+                    p['airdate'],
+                    self.nameId(artist['name'] if artist is not None
+                                else None),
+                    self.nameId(track['name'] if track is not None
+                                else None)))
+            self.db.execute(
+                'DELETE FROM plays WHERE airdate >= ? AND airdate < ?',
+                (begin, until))
+            self.db.executemany('INSERT INTO plays VALUES (?,?,?)', rows)
+            self.db.executemany(
+                'INSERT OR REPLACE INTO hours VALUES (?,?,?)',
+                [(k, n, fetchedAt) for k, n in counts.items()])
+            for day in days:
+                self.db.execute('DELETE FROM day_summaries WHERE day=?',
+                                (day,))
+
+    def iterRange(self, start, end):
+        # Yields plays with start <= airdate < end, in airdate order, shaped
+        # like the KEXP records downstream code reads.
+        names = self.names
+        for airdate, artist, track in self.db.execute(
+                'SELECT airdate, artist, track FROM plays'
+                ' WHERE airdate >= ? AND airdate < ?'
+                ' ORDER BY airdate, rowid',
+                (formatDate(start), formatDate(end))):
+            yield {
+                'airdate': airdate,
+                'artist': {'name': names[artist]}
+                if artist is not None else None,
+                'track': {'name': names[track]}
+                if track is not None else None}
+
+    def loadRange(self, start, end):
+        return list(self.iterRange(start, end))
+
+    def dayGroups(self, day, pivot):
+        # Per-day pre-aggregate: the day's plays grouped by `pivot`, as a
+        # play count and the songs played per group. Built for every pivot
+        # from the raw plays the first time it is asked for, then persisted
+        # (one JSON document per day and pivot, {group: [plays, songs]})
+        # until any hour of the day is re-stored. Days that aren't complete
+        # yet are grouped but not persisted.
+        key = dayKey(day)
+        row = self.db.execute(
+            'SELECT groups FROM day_summaries WHERE day=? AND pivot=?',
+            (key, pivot)).fetchone()
+        if row is not None:
+            return dict((grp, {'plays': plays,
+                               'songs': set(map(tuple, songs))})
+                        for grp, (plays, songs) in json.loads(row[0]).items())
+        built = groupPivots(
+            self.iterRange(day, day + datetime.timedelta(days=1)))
+        if self.hasDay(day):
+            with self.db:
+                self.db.executemany(
+                    'INSERT OR REPLACE INTO day_summaries VALUES (?,?,?)',
+                    [(key, p, json.dumps(dict(
+                        (grp, [g['plays'], sorted(g['songs'])])
+                        for grp, g in groups.items())))
+                     for p, groups in built.items()])
+        return built[pivot]
+
+    def windowGroups(self, days, pivot):
+        # Groups for a window of days: the daily pre-aggregates' play counts
+        # added up and their songs merged.
+        result = {}
+        names = {}
+        for day in days:
+            mergeGroups(result, self.dayGroups(day, pivot), pivot, names)
+        return result
+
+    def loadRaw(self, start, end):
+        # Full KEXP records kept with keepRaw, decompressing only the hours
+        # that overlap [start, end).
+        db = self.rawDb(create=False)
+        if db is None:
+            return []
+        begin = formatDate(start)
+        until = formatDate(end)
+        result = []
+        for (records,) in db.execute(
+                'SELECT records FROM raw_hours WHERE hour >= ? AND hour < ?'
+                ' ORDER BY hour',
+                (begin[:len('YYYY-MM-DDTHH')], until)):
+            result.extend(
+                p for p in json.loads(zlib.decompress(records))
+                if begin <= p['airdate'] < until)
+        return result
+
+    def importJsonCache(self, cacheDir='cache'):
+        # One-off migration of the old cache/YYYYMMDD.json day files.
+        imported = []
+        for fn in sorted(glob.glob(os.path.join(cacheDir, '*.json'))):
+            try:
+                day = datetime.datetime.strptime(
+                    os.path.basename(fn)[:-len('.json')], "%Y%m%d")
+            except ValueError:
+                continue
+            if self.knownDay(day):
+                continue
+            with open(fn, 'r', encoding='utf-8') as inCache:
+                self.addDay(day, json.load(inCache), os.path.getmtime(fn))
+            imported.append(day)
+        return imported
@@ -0,0 +1,256 @@
+import datetime
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from metrics import metrics
+
+KEXP_API = 'https://legacy-api.kexp.org'
+
+
+# Plays per hour assumed for hours of the day the store has no history
+# for, and the share of a page a planned window may be expected to fill.
+DEFAULT_DENSITY = 20
+PAGE_FILL = 0.75
+HOUR = datetime.timedelta(hours=1)
+
+
+def formatDate(date):
+    return date.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def parseAirdate(airdate):
+    # Naive UTC datetime, to the second, of an API airdate string.
+    d = datetime.datetime.fromisoformat(airdate.replace('Z', '+00:00'))
+    if d.tzinfo is not None:
+        d = d.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return d.replace(microsecond=0)
+
+
+def hourRange(start, end):
+    hours = []
+    while start < end:
+        hours.append(start)
+        start += HOUR
+    return hours
+
+
+class TokenBucket:
+    # Global politeness limit shared by every fetch thread. Tokens refill
+    # continuously at `rate` per second up to `capacity`; each request
+    # takes one token and blocks until one is available.
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None
+                              else max(1.0, self.rate))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity,
+                                  self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            metrics.count('kexp.throttle_seconds', wait)
+            time.sleep(wait)
+
+
+class Fetcher:
+    # Fetches KEXP plays in windows of whole hours. Windows are planned from
+    # the expected plays per hour of day (see CatalogStore.hourDensity) so
+    # that each one should fit on a single page of `pageSize` plays, and run
+    # concurrently on a thread pool over one pooled session.
+    #
+    # A window that turns out denser than planned is not paged through by
+    # offset: the plays up to the last airdate on the first page are kept
+    # and the rest of the window is split, by the density that page showed,
+    # into pieces that are fetched concurrently like any other window.
+    def __init__(self, requestsPerSecond=5, maxWorkers=8, baseUrl=KEXP_API,
+                 log=None, pageSize=200, maxWindowHours=24):
+        # requests is imported here so that runs that never fetch (the
+        # catalog store already has every hour) don't pay for it.
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        self.baseUrl = baseUrl
+        self.log = log
+        self.pageSize = pageSize
+        self.maxWindowHours = maxWindowHours
+        self.limiter = TokenBucket(requestsPerSecond)
+        self.session = metrics.instrument(requests.Session())
+        adapter = HTTPAdapter(pool_connections=maxWorkers,
+                              pool_maxsize=maxWorkers)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.pool = ThreadPoolExecutor(max_workers=maxWorkers)
+
+    @classmethod
+    def fromConfig(cls, config, log=None):
+        return cls(
+            requestsPerSecond=config.get('requestsPerSecond', 5),
+            maxWorkers=config.get('fetchWorkers', 8),
+            baseUrl=config.get('kexpBaseUrl', KEXP_API),
+            log=log,
+            pageSize=config.get('kexpPageSize', 200),
+            maxWindowHours=config.get('maxWindowHours', 24))
+
+    def close(self):
+        self.pool.shutdown(wait=True)
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def makeUrl(self, startdate, enddate):
+        return '{}/play?begin_time={}&end_time={}&ordering=airdate' \
+            '&limit={}'.format(self.baseUrl, formatDate(startdate),
+                               formatDate(enddate), self.pageSize)
+
+    def get(self, url):
+        self.limiter.acquire()
+        result = self.session.get(url, timeout=30)
+        # raises requests.exceptions.HTTPError on failure
+        result.raise_for_status()
+        return result.json()
+
+    def getPage(self, url):
+        if self.log is not None:
+            self.log('\t' + url.replace(self.baseUrl, ''))
+        response = self.get(url)
+        metrics.count('kexp.pages')
+        metrics.count('kexp.plays', len(response['results']))
+        return response
+
+    def fetchPiece(self, start, end):
+        # One page of [start, end). Returns the plays and, if the page
+        # didn't hold them all, the time the rest of the range starts at;
+        # plays from then on are left for the caller to fetch.
+        response = self.getPage(self.makeUrl(start, end))
+        page = response['results']
+        rest = None
+        if response['next'] is not None and len(page) > 0:
+            if len(page) < self.pageSize:
+                # the API caps the page size below what we asked for
+                self.pageSize = len(page)
+            rest = parseAirdate(page[-1]['airdate'])
+            if rest > start:
+                page = [t for t in page if parseAirdate(t['airdate']) < rest]
+            else:
+                # a whole page on one second; fall back to offset paging
+                rest = None
+                nextUrl = response['next']
+                while nextUrl is not None:
+                    response = self.getPage(nextUrl)
+                    page += response['results']
+                    nextUrl = response['next'] \
+                        if len(response['results']) > 0 else None
+        return [t for t in page if 'track' in t], rest
+
+    def planWindows(self, hours, density=None):
+        # Groups consecutive hours into windows whose expected plays fit on
+        # one page. density: {hour of day: expected plays}.
+        density = density or {}
+        budget = PAGE_FILL * self.pageSize
+        windows = []
+        load = 0
+        for h in sorted(hours):
+            expected = density.get(h.hour, DEFAULT_DENSITY)
+            if len(windows) > 0 and windows[-1][1] == h and \
+                    load + expected <= budget and \
+                    windows[-1][1] - windows[-1][0] < \
+                    self.maxWindowHours * HOUR:
+                windows[-1][1] = h + HOUR
+                load += expected
+            else:
+                windows.append([h, h + HOUR])
+                load = expected
+        return [tuple(w) for w in windows]
+
+    def splitRest(self, start, rest, end, fetched):
+        # Pieces covering [rest, end), sized by the rate the first page of
+        # [start, end) showed.
+        rate = fetched / max((rest - start).total_seconds(), 1)
+        expected = rate * (end - rest).total_seconds()
+        n = max(1, min(int(-(-expected // (PAGE_FILL * self.pageSize))),
+                       int((end - rest).total_seconds() // 60) or 1))
+        step = (end - rest) / n
+        cuts = [rest + i * step for i in range(n)] + [end]
+        cuts = [c.replace(microsecond=0) for c in cuts]
+        return [(a, b) for a, b in zip(cuts, cuts[1:]) if a < b]
+
+    def iterWindows(self, hours, density=None, inFlight=96):
+        # Yields (start, end, plays, error) as each planned window of whole
+        # hours finishes, plays in airdate order. At most `inFlight` hours
+        # are queued or held at once (but always at least one window). A
+        # failed window is reported with its exception instead of stopping
+        # the others.
+        from requests.exceptions import RequestException
+
+        windows = iter(self.planWindows(hours, density))
+        pending = {}
+        active = {}
+
+        def submit(window, start, end):
+            window['pieces'] += 1
+            pending[self.pool.submit(self.fetchPiece, start, end)] = \
+                (window, start, end)
+
+        def fill():
+            held = sum((w['end'] - w['start']) // HOUR
+                       for w in active.values())
+            while held < inFlight or len(active) == 0:
+                planned = next(windows, None)
+                if planned is None:
+                    return
+                start, end = planned
+                window = {'start': start, 'end': end, 'pieces': 0,
+                          'plays': [], 'error': None}
+                active[start] = window
+                metrics.count('kexp.windows')
+                submit(window, start, end)
+                held += (end - start) // HOUR
+
+        fill()
+        try:
+            while len(pending) > 0:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for f in done:
+                    window, start, end = pending.pop(f)
+                    window['pieces'] -= 1
+                    try:
+                        plays, rest = f.result()
+                    except RequestException as err:
+                        metrics.count('kexp.errors')
+                        window['error'] = err
+                    else:
+                        window['plays'] += plays
+                        if rest is not None and window['error'] is None:
+                            pieces = self.splitRest(start, rest, end,
+                                                    len(plays))
+                            metrics.count('kexp.splits', len(pieces))
+                            for a, b in pieces:
+                                submit(window, a, b)
+                    if window['pieces'] > 0:
+                        continue
+                    del active[window['start']]
+                    if window['error'] is not None:
+                        yield window['start'], window['end'], None, \
+                            window['error']
+                    else:
+                        yield window['start'], window['end'], \
+                            sorted(window['plays'],
+                                   key=lambda t: t['airdate']), None
+                    fill()
+        finally:
+            for f in pending:
+                f.cancel()
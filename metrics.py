@@ -0,0 +1,125 @@
+import cProfile
+import json
+import os
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+# Upper bounds (seconds) of the HTTP latency histogram buckets.
+BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Metrics:
+    # Process-wide timers and counters. Stages accumulate wall time under a
+    # name; counters are free-form dotted names; HTTP latency is kept as a
+    # histogram per host. summary() is plain JSON-able data.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.stages = {}
+        self.counters = Counter()
+        self.latency = {}
+        self.memory = {}
+        self.profile = None
+        self.profileDir = 'profile'
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] += n
+
+    def observe(self, host, seconds):
+        with self.lock:
+            h = self.latency.setdefault(host, {
+                'count': 0, 'sum': 0.0, 'max': 0.0,
+                'buckets': [0] * (len(BUCKETS) + 1)})
+            h['count'] += 1
+            h['sum'] += seconds
+            h['max'] = max(h['max'], seconds)
+            i = 0
+            while i < len(BUCKETS) and seconds > BUCKETS[i]:
+                i += 1
+            h['buckets'][i] += 1
+
+    def responseHook(self, response, *args, **kwargs):
+        host = urlparse(response.url).hostname
+        self.observe(host, response.elapsed.total_seconds())
+        self.count('http.{}.requests'.format(host))
+        self.count('http.{}.status.{}'.format(host, response.status_code))
+        return response
+
+    def instrument(self, session):
+        # Records every response made through a requests.Session.
+        session.hooks['response'].append(self.responseHook)
+        return session
+
+    @contextmanager
+    def stage(self, name, hot=False):
+        # Times a stage. Hot stages are also profiled when profiling is on:
+        # 'cprofile' writes profile/<stage>.prof (main thread only) and
+        # 'tracemalloc' records the stage's peak traced memory.
+        profiler = None
+        if hot and self.profile == 'cprofile':
+            profiler = cProfile.Profile()
+            profiler.enable()
+        elif hot and self.profile == 'tracemalloc':
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            tracemalloc.reset_peak()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                self.stages[name] = self.stages.get(name, 0.0) + elapsed
+            if profiler is not None:
+                profiler.disable()
+                os.makedirs(self.profileDir, exist_ok=True)
+                profiler.dump_stats(
+                    os.path.join(self.profileDir, name + '.prof'))
+            elif hot and self.profile == 'tracemalloc':
+                _, peak = tracemalloc.get_traced_memory()
+                with self.lock:
+                    self.memory[name] = max(self.memory.get(name, 0), peak)
+
+    def hitRate(self, prefix):
+        hits = self.counters[prefix + '.hits']
+        total = hits + self.counters[prefix + '.misses']
+        return round(hits / total, 4) if total else None
+
+    def summary(self):
+        with self.lock:
+            result = {
+                'stages': {k: round(v, 4) for k, v in self.stages.items()},
+                'counters': dict(sorted(self.counters.items())),
+                'http_latency': {
+                    host: dict(h, sum=round(h['sum'], 4),
+                               max=round(h['max'], 4),
+                               buckets=dict(zip(
+                                   [str(b) for b in BUCKETS] + ['inf'],
+                                   h['buckets'])))
+                    for host, h in self.latency.items()},
+            }
+        result['cache'] = {
+            'kexp_hit_rate': self.hitRate('cache.kexp'),
+            'search_hit_rate': self.hitRate('cache.search'),
+        }
+        if len(self.memory) > 0:
+            result['peak_memory'] = dict(self.memory)
+        return result
+
+    def write(self, path=None):
+        text = json.dumps(self.summary(), indent=1)
+        if path is None:
+            print(text)
+        else:
+            with open(path, 'w', encoding='utf-8') as outMetrics:
+                outMetrics.write(text)
+
+
+metrics = Metrics()
@@ -0,0 +1,66 @@
+import re
+import unicodedata
+from functools import lru_cache
+
+# Name clean-up shared by the grouping (PlayIndex, aggregate), the search
+# queries and the candidate matcher (spotifyResolve). Rules are compiled
+# once and the canonical forms are memoized, since the same few thousand
+# artist and track names come round on every play.
+
+FEAT_PAREN = re.compile(r'\(feat. .*\)')
+FEAT_BRACKETED = re.compile(r'[\(\[](feat\.|ft\.|featuring)\s[^\)\]]*[\)\]]')
+FEAT_TAIL = re.compile(r'\b(feat\.|ft\.|featuring)\s.*$')
+PUNCTUATION = re.compile(r'[^\w\s]')
+VERSION_SUFFIX = re.compile(r'\s+-\s+.*$')
+BRACKETED = re.compile(r'[\(\[][^\)\]]*[\)\]]')
+
+CACHE_SIZE = 1 << 16
+
+
+def cleanSong(song):
+    # The title as searched for and cached: no "(feat. X)".
+    return FEAT_PAREN.sub('', song).strip()
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def normalize(text):
+    # Lower case, no accents, no "feat. X" credit, '&' spelled out and
+    # punctuation dropped, so spellings of one name compare equal. A
+    # bracketed credit is dropped up to its closing bracket ("Song (feat.
+    # X) (Live)" keeps "(Live)"), a bare one to the end. A name that is all
+    # punctuation ("!!!") is kept as it is.
+    if text.isascii():
+        folded = text.lower()
+    else:
+        folded = unicodedata.normalize('NFKD', text)
+        folded = ''.join(c for c in folded
+                         if not unicodedata.combining(c)).lower()
+    folded = FEAT_TAIL.sub('', FEAT_BRACKETED.sub(' ', folded))
+    folded = PUNCTUATION.sub(' ', folded.replace('&', ' and '))
+    return ' '.join(folded.split()) or text.strip().lower()
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def normalizeArtist(artist):
+    artist = normalize(artist)
+    return artist[len('the '):] if artist.startswith('the ') else artist
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def normalizeTitle(title):
+    # For matching against Spotify, whose titles carry versions KEXP
+    # leaves out ("Song - Remastered 2011", "Song (Live)"); they are
+    # dropped on both sides.
+    stripped = BRACKETED.sub('', VERSION_SUFFIX.sub('', title))
+    return normalize(stripped) if stripped.strip() else normalize(title)
+
+
+# Grouping keys: variants of a name that map to the same key are one
+# artist or one song. Versions are kept apart here ("Song (Live)" is its
+# own song), only spelling is folded.
+artistKey = normalizeArtist
+titleKey = normalize
+
+
+def songKey(artist, title):
+    return artistKey(artist), titleKey(title)
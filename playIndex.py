@@ -0,0 +1,128 @@
+from array import array
+
+from normalize import artistKey, titleKey
+
+
+class Interner:
+    # Maps values to dense integer ids and back. Values can be interned
+    # under a separate key, in which case the first value seen for a key
+    # is the one kept.
+    __slots__ = ('ids', 'values')
+
+    def __init__(self):
+        self.ids = {}
+        self.values = []
+
+    def __len__(self):
+        return len(self.values)
+
+    def __getitem__(self, i):
+        return self.values[i]
+
+    def intern(self, value, key=None):
+        key = value if key is None else key
+        i = self.ids.get(key)
+        if i is None:
+            i = self.ids[key] = len(self.values)
+            self.values.append(value)
+        return i
+
+    def get(self, key):
+        return self.ids.get(key)
+
+
+class PlayIndex:
+    # Compact play catalog shared by processCatalog and plotChart. Artist
+    # names, tracks and airdates are interned to integer ids and plays are
+    # stored as three parallel arrays of those ids. A track is one title by
+    # one artist, so the track pivot is the artist x track pivot.
+    #
+    # Artists and titles are interned by their normalize keys, so spelling
+    # variants ("A & B" / "A and B", "Song (feat. X)" / "Song") are one
+    # artist or track, named after the first variant played.
+    #
+    # Plays with no artist or track (air breaks) are skipped.
+    __slots__ = ('artists', 'tracks', 'airdates', 'trackArtist',
+                 'playAirdate', 'playArtist', 'playTrack', 'skipped')
+
+    def __init__(self):
+        self.artists = Interner()
+        self.tracks = Interner()        # (artistId, title)
+        self.airdates = Interner()
+        self.trackArtist = array('i')
+        self.playAirdate = array('i')
+        self.playArtist = array('i')
+        self.playTrack = array('i')
+        self.skipped = 0
+
+    @classmethod
+    def fromPlays(cls, plays):
+        index = cls()
+        index.addAll(plays)
+        return index
+
+    def __len__(self):
+        return len(self.playTrack)
+
+    def addAll(self, plays):
+        for r in plays:
+            self.add(r)
+        return self
+
+    def add(self, r):
+        if r['track'] is None or r['artist'] is None:
+            self.skipped += 1
+            return
+        artist = r['artist']['name']
+        title = r['track']['name']
+        a = self.artists.intern(artist, artistKey(artist))
+        n = len(self.tracks)
+        t = self.tracks.intern((a, title), (a, titleKey(title)))
+        if t == n:
+            self.trackArtist.append(a)
+        self.playAirdate.append(self.airdates.intern(r['airdate']))
+        self.playArtist.append(a)
+        self.playTrack.append(t)
+
+    def artistName(self, a):
+        return self.artists[a]
+
+    def trackName(self, t):
+        return self.tracks[t][1]
+
+    def pivots(self):
+        # One pass over the plays building every pivot at once:
+        #   artistPlays[a] / trackPlays[t]: sets of unique airdate ids
+        #   artistTracks[a]: set of track ids played for artist a
+        # Plays are counted by unique airdate since the KEXP playlist
+        # sometimes has duplicates.
+        artistPlays = [set() for _ in range(len(self.artists))]
+        trackPlays = [set() for _ in range(len(self.tracks))]
+        artistTracks = [set() for _ in range(len(self.artists))]
+        for d, a, t in zip(self.playAirdate, self.playArtist, self.playTrack):
+            artistPlays[a].add(d)
+            trackPlays[t].add(d)
+            artistTracks[a].add(t)
+        return {'artist': artistPlays, 'track': trackPlays,
+                'artistTracks': artistTracks}
+
+    def groups(self, pivot='artist', pivots=None):
+        # The name-keyed form the ranking and the day store use:
+        # {group: {'plays': unique airdates, 'songs': set of (artist, track)}}
+        # where a track group is keyed "track; artist".
+        pivots = self.pivots() if pivots is None else pivots
+        result = {}
+        if pivot == 'track':
+            for t, plays in enumerate(pivots['track']):
+                a, title = self.tracks[t]
+                artist = self.artists[a]
+                result[title + '; ' + artist] = {
+                    'plays': len(plays),
+                    'songs': {(artist, title)}}
+        else:
+            for a, plays in enumerate(pivots['artist']):
+                result[self.artists[a]] = {
+                    'plays': len(plays),
+                    'songs': set((self.artists[a], self.trackName(t))
+                                 for t in pivots['artistTracks'][a])}
+        return result
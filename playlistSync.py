@@ -0,0 +1,129 @@
+TRACK_URI = 'spotify:track:{}'
+BATCH = 100
+
+
+def trackUri(track_id):
+    return track_id if track_id.startswith('spotify:') \
+        else TRACK_URI.format(track_id)
+
+
+def readPlaylist(sp, pl_id):
+    # Current item URIs in playlist order, plus the snapshot they belong to.
+    snapshot = sp.playlist(pl_id, fields='snapshot_id')['snapshot_id']
+    uris = []
+    page = sp.playlist_items(pl_id, fields='items(track(uri)),next',
+                             limit=100, additional_types=['track'])
+    while page is not None:
+        for item in page['items']:
+            track = item.get('track')
+            uris.append(track['uri'] if track else None)
+        page = sp.next(page) if page.get('next') else None
+    return uris, snapshot
+
+
+def planSync(current, target):
+    # Minimal edit script turning `current` into `target` (both lists of
+    # URIs; target has no duplicates). Returns a dict with:
+    #   removes: {uri: [positions in current]}
+    #   moves:   [(range_start, insert_before, range_length)] applied in
+    #            order to the list left after removes
+    #   adds:    [(position, [uris])] applied in order after the moves
+    wanted = set(target)
+    removes = {}
+    kept = []
+    seen = set()
+    for pos, uri in enumerate(current):
+        if uri is None or uri not in wanted or uri in seen:
+            removes.setdefault(uri, []).append(pos)
+        else:
+            seen.add(uri)
+            kept.append(uri)
+
+    # Reorder the kept items into target order, moving whole runs that
+    # are already contiguous.
+    order = [uri for uri in target if uri in seen]
+    moves = []
+    work = list(kept)
+    for i, uri in enumerate(order):
+        if work[i] == uri:
+            continue
+        j = work.index(uri, i)
+        length = 1
+        while (j + length < len(work) and i + length < len(order) and
+               work[j + length] == order[i + length]):
+            length += 1
+        moves.append((j, i, length))
+        work[i:i] = work[j:j + length]
+        del work[j + length:j + 2 * length]
+
+    # Insert new items at their final positions, in runs of up to BATCH.
+    adds = []
+    for i, uri in enumerate(target):
+        if uri in seen:
+            continue
+        if len(adds) > 0 and adds[-1][0] + len(adds[-1][1]) == i and \
+                len(adds[-1][1]) < BATCH:
+            adds[-1][1].append(uri)
+        else:
+            adds.append((i, [uri]))
+    return {'removes': removes, 'moves': moves, 'adds': adds}
+
+
+def describePlan(plan):
+    lines = []
+    for uri, positions in plan['removes'].items():
+        lines.append('remove {} at {}'.format(uri, positions))
+    for start, before, length in plan['moves']:
+        lines.append('move {} item(s) from {} to before {}'.format(
+            length, start, before))
+    for position, uris in plan['adds']:
+        lines.append('add {} item(s) at {}: {}'.format(
+            len(uris), position, ', '.join(uris)))
+    if len(lines) == 0:
+        lines.append('playlist already up to date')
+    return lines
+
+
+def applyPlan(sp, pl_id, plan, snapshot):
+    # Removes go highest position first so earlier positions stay valid;
+    # removes and moves are pinned to the snapshot they were planned on.
+    removals = sorted(((pos, uri) for uri, positions
+                       in plan['removes'].items() for pos in positions),
+                      reverse=True)
+    for i in range(0, len(removals), BATCH):
+        batch = {}
+        for pos, uri in removals[i:i + BATCH]:
+            batch.setdefault(uri, []).append(pos)
+        snapshot = sp.playlist_remove_specific_occurrences_of_items(
+            pl_id, [{'uri': uri, 'positions': positions}
+                    for uri, positions in batch.items()],
+            snapshot_id=snapshot)['snapshot_id']
+    for start, before, length in plan['moves']:
+        snapshot = sp.playlist_reorder_items(
+            pl_id, start, before, range_length=length,
+            snapshot_id=snapshot)['snapshot_id']
+    for position, uris in plan['adds']:
+        snapshot = sp.playlist_add_items(
+            pl_id, uris, position=position)['snapshot_id']
+    return snapshot
+
+
+def syncPlaylist(sp, pl_id, track_ids, dryRun=False, log=print):
+    # Brings the playlist in line with `track_ids` using the fewest calls
+    # we can plan. Returns the plan.
+    current, snapshot = readPlaylist(sp, pl_id)
+    if None in current:
+        # Unavailable items have no URI to remove by, so fall back to
+        # planning against an empty playlist and replacing everything.
+        log('\tplaylist has unavailable items, replacing it in full')
+        plan = planSync([], [trackUri(t) for t in track_ids])
+        if not dryRun:
+            sp.playlist_replace_items(pl_id, [])
+            applyPlan(sp, pl_id, plan, None)
+        return plan
+    plan = planSync(current, [trackUri(t) for t in track_ids])
+    for line in describePlan(plan):
+        log('\t' + line)
+    if not dryRun:
+        applyPlan(sp, pl_id, plan, snapshot)
+    return plan
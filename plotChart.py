@@ -1,17 +1,9 @@
 import json
-
-import pprint
-import sys
-import os
-import subprocess
-
-import spotipy
-import spotipy.util as util
-import datetime
-import time
-import requests
-import re
 import argparse
+from functools import partial
+
+from playIndex import PlayIndex
+from processCatalog import setEnvironment, streamFromKEXP
 
 # Sample config:
 # Visit https://developer.spotify.com/dashboard/applications to create a clientid.
@@ -27,253 +19,225 @@ import argparse
 #
 # }    
 
-def setEnvironment(config):
-    if 'environment' in config:
-        for e in config['environment']:
-            os.environ[e]=config['environment'][e]
-
-def formatDate(date):
-    return date.strftime("%Y-%m-%dT%H:%M:%SZ")
-
-def makeUrl(startdate, enddate):
-    print(startdate,enddate)
-    return '{}/play?begin_time={}&end_time={}&ordering=airdate'.format(
-        'https://legacy-api.kexp.org',
-        formatDate(startdate), formatDate(enddate))
-
-def fetchDate(start, end):
-    # TODO: this is currently only capturing the first 100 tracks of the day.
-    cacheFn = 'cache/{}.json'.format(start.strftime("%Y%m%d"))
-    print("Fetching {}".format(start.strftime("%Y-%m-%d")))                        
-    
-    if not os.path.exists(cacheFn): 
-        cachetracks=[]
-        while (start<end):       
-            nextUrl = makeUrl(start, start+datetime.timedelta(hours=1))
-            while nextUrl is not None:
-                print('\t'+nextUrl.replace('https://legacy-api.kexp.org',''))
-                result=requests.get(nextUrl)
-                if result.ok:
-                    response = result.json()
-                    tracks = response['results']
-                    nextUrl = response['next'] if len(tracks)>0 else None
-                    print(len(tracks))
-                    for t in tracks:
-                        #print(json.dumps(t))
-                        if 'track' in t:
-                            cachetracks.append(t)
-                            #print(t['airdate'])
-                else:
-                    try:
-                        result.raise_for_status()
-                    except requests.exceptions.HTTPError as err:
-                        print(err)
-                        sys.exit(1)
-                    #print(json.dumps(result))
-                    nextUrl=None
-            start=start+datetime.timedelta(hours=1)
-            time.sleep(1)
-            #print(formatDate(start))
-            #exit()
-
-        with open(cacheFn,'w', encoding='utf-8') as outCache:
-            outCache.write(json.dumps(cachetracks))
-    tracks=[]
-    print("Loading {}".format(cacheFn))
-    with open(cacheFn, 'r', encoding='utf-8') as inCache:
-        tracks = json.load(inCache)
-    print(len(tracks))
-    return tracks
-
-
-
-def collectFromKEXP(config):
-    daysToParse= config['daysToParse'] if 'daysToParse' in config else 7
-
-    today = datetime.datetime.fromordinal(datetime.datetime.utcnow().date().toordinal())
-    start_date = today - datetime.timedelta(days=daysToParse)
-    end_date = start_date + datetime.timedelta(days=1)
-    results = []
-    while (start_date<today):
-        results += fetchDate(start_date,end_date)
-        start_date = start_date + datetime.timedelta(days=1)
-        end_date = start_date + datetime.timedelta(days=1)
-    print("All results: ",len(results))
-    return results  
-    
-
-def plotArtistTrack(config, catalog):
-    all_results={}
-
-    pivots = ['artist','track']
-    # we rank artists by most plays, take the top 25 and 
-    # add their played tracks to the playlist.
-    #pivot = config['pivot'] if 'pivot' in config else 'artist'
-    for pivot in pivots:
-        result = {}
-        print(f'Grouping by {pivot}')
-        for r in catalog:
-            if r['track'] is None:
-                continue
-            artistid = r[pivot]['name']
-            if pivot == 'track':
-                artistid += ';;'+r['artist']['name']
-            if artistid not in result:
-                result[artistid]={'track':r, 'plays':set(), 'songs':set()}
-            result[artistid]['plays'].add(r['airdate']) # count by unique timestamps. Sometimes the playlist has duplicates.
-            result[artistid]['songs'].add((r['artist']['name'],r['track']['name']))
-        all_results[pivot]=result
-        
-    from collections import Counter
+def artistTrackData(index):
+    # each track by its own plays vs. its artist's plays, as
+    # [track plays, artist plays, ['title;;artist', ...]] points
+    pivots = index.pivots()
     ctr = {}
-    for t in all_results['track']:
-        (track,_,artist) = t.split(';')
-        track_plays = len(all_results['track'][t]['plays'])
-        artist_plays = len(all_results['artist'][artist]['plays'])
-        #print(t,track_plays, artist_plays)
+    for t, plays in enumerate(pivots['track']):
+        track_plays = len(plays)
+        artist_plays = len(pivots['artist'][index.trackArtist[t]])
         key = (track_plays, artist_plays)
         if key not in ctr:
             ctr[key]=set()
         ctr[key].add(t)
-    
+    return [[x, y, sorted('{};;{}'.format(index.trackName(t), index.artistName(index.trackArtist[t])) for t in ctr[(x,y)])]
+            for (x,y) in sorted(ctr)]
+
+def artistTrackFigure(points, tooltips=False):
     import matplotlib.pyplot as plt
-    import mpld3
-    from math import log, ceil
+    from math import log
 
-    data = [(x,y,ctr[(x,y)]) for (x,y) in ctr]
-    x_track=[d[0] for d in data]
-    y_artist=[d[1] for d in data]
-    count = [len(d[2]) for d in data]
-    labels = [','.join(d[2]) for d in data]
+    x_track=[d[0] for d in points]
+    y_artist=[d[1] for d in points]
+    count = [len(d[2]) for d in points]
+    labels = [','.join(d[2]) for d in points]
     
     fig, ax = plt.subplots(figsize=(4,2)) #subplot_kw=dict(axisbg='#EEEEEE'))
     scatter = ax.scatter(x_track, y_artist, s=[3*log(c+1) for c in count])
-    xint = range(min(x_track), ceil(max(x_track))+1)
+    #xint = range(min(x_track), ceil(max(x_track))+1)
     #ax.set_xticks(xint)
     ax.set_xlabel('Track Plays')
     ax.set_ylabel('Artist Plays')
-    tooltip = mpld3.plugins.PointLabelTooltip(scatter, labels=labels)
-    mpld3.plugins.connect(fig, tooltip)
+    if tooltips:
+        import mpld3
+        tooltip = mpld3.plugins.PointLabelTooltip(scatter, labels=labels)
+        mpld3.plugins.connect(fig, tooltip)
+    return fig
+
+def plotArtistTrack(config, index):
+    print('Grouping by artist and track')
+    import mpld3
+    artistTrackFigure(artistTrackData(index), tooltips=True)
     mpld3.show()
     #plt.show()
-    #print(ctr)
 
-def plotTop40(config, catalog):
-    from datetime import datetime
+def weekIndex(days):
+    # epiweeks (MMWR) weeks start on Sunday. 1970-01-01 was a Thursday, so
+    # shifting by 4 days makes every Sunday-Saturday run share one index.
+    return (days + 4) // 7
+
+def weekStart(index):
+    from datetime import date, timedelta
+    return date(1970,1,1) + timedelta(days=int(index)*7 - 4)
+
+def weeklyArtistCounts(index):
+    # Vectorized weekly bucketing over a PlayIndex: for every (week, artist)
+    # pair with plays, its week index, artist id and the number of unique
+    # airdates.
+    import numpy as np
+    nAirdates = max(len(index.airdates), 1)
+    seconds = np.array([d.rstrip('Z') for d in index.airdates.values], dtype='datetime64[s]').astype(np.int64)
+    # count by unique timestamps. Sometimes the playlist has duplicates.
+    pairs = np.unique(np.frombuffer(index.playArtist, dtype=np.int32).astype(np.int64) * nAirdates
+                      + np.frombuffer(index.playAirdate, dtype=np.int32))
+    artists = pairs // nAirdates
+    weeks = weekIndex(seconds[pairs % nAirdates] // 86400)
+    nArtists = max(len(index.artists), 1)
+    keys, counts = np.unique(weeks * nArtists + artists, return_counts=True)
+    return keys // nArtists, keys % nArtists, counts
+
+def weeklyRankData(index, N=10, W=20):
+    # The top N artists of each of the last W weeks:
+    # {'weeks': [week start, ...], 'top': [[artist, ...] per week]}
+    import numpy as np
+    weekIds, artistCodes, counts = weeklyArtistCounts(index)
+    weeks = np.unique(weekIds)[-W:]
+    top = []
+    for w in weeks:
+        inWeek = weekIds == w
+        order = sorted(zip(-counts[inWeek], [index.artistName(a) for a in artistCodes[inWeek]]))
+        top.append([a for _, a in order[:N]])
+    return {'weeks': [weekStart(w).isoformat() for w in weeks], 'top': top}
+
+def weeklyRankFigure(data):
+    import matplotlib.pyplot as plt
+    from math import isnan
+    weeks = data['weeks']
+    N = max([len(t) for t in data['top']] + [1])
+    plots = {}
+    for w, topN in zip(weeks, data['top']):
+        for i,a in enumerate(topN):
+            if a not in plots:
+                plots[a]=[]
+            plots[a].append((w,i))
+    x_values = dict([(k,v+1) for (v,k) in enumerate(weeks)])
+    fig, ax = plt.subplots(figsize=(12,8)) #subplot_kw=dict(axisbg='#EEEEEE'))
+    for a in plots:
+        lookup = dict(plots[a])
+        X = [x_values[w] for w in weeks]
+        Y = [N-lookup[w] if w in lookup else float('NaN') for w in weeks]
+        ax.plot(X, Y, 'o-')
+        for i in range(len(X)):
+            if not isnan(Y[i]) and (i==0 or isnan(Y[i-1])):
+                ax.text(X[i],Y[i]+0.15, a, ha='center', fontsize=8)
+    ax.set_yticks(range(N+1))
+    ax.set_yticklabels(['']+[str(N-y) for y in range(N)])
+    ax.set_xticks(range(1, len(weeks)+1))
+    ax.set_xticklabels(weeks, rotation=90)
+    plt.tight_layout()
+    return fig
+
+def playsPerWeekData(index, threshold='2020-05-26', N=20):
+    # Plays per week before and after `threshold` for the N most played
+    # artists, least played first:
+    # {'threshold', 'weeksBefore', 'weeksAfter', 'artists': [[artist, before, after], ...]}
+    # A side with no weeks in the catalog has None rates.
+    import numpy as np
+    weekIds, artistCodes, counts = weeklyArtistCounts(index)
+    weeks = np.unique(weekIds)
+    cut = weekIndex(np.datetime64(threshold, 'D').astype(np.int64))
+    prior = weekIds < cut
+    weeksBefore = int(np.sum(weeks < cut))
+    weeksAfter = int(np.sum(weeks >= cut))
+    before = np.bincount(artistCodes[prior], weights=counts[prior], minlength=len(index.artists))
+    after = np.bincount(artistCodes[~prior], weights=counts[~prior], minlength=len(index.artists))
+    played = np.flatnonzero(before + after)
+    top = sorted(played, key=lambda a: (before[a] + after[a], index.artistName(a)))[-N:]
+    return {'threshold': threshold, 'weeksBefore': weeksBefore, 'weeksAfter': weeksAfter,
+            'artists': [[index.artistName(a),
+                         float(before[a]) / weeksBefore if weeksBefore else None,
+                         float(after[a]) / weeksAfter if weeksAfter else None] for a in top]}
+
+def playsPerWeekFigure(data):
+    import matplotlib.pyplot as plt
+    fig, ax = plt.subplots(figsize=(12,8)) 
+    labels = []
+    for i,(a, before, after) in enumerate(data['artists']):
+        ax.plot([2*i-0.5,2*i+0.5], [float('NaN') if before is None else before, float('NaN') if after is None else after],'o-')
+        labels.append(a)
+    ax.set_xticks([2*i for i in range(len(labels))])
+    ax.set_xticklabels(labels, rotation=90)
+    ax.set_ylabel('Plays per Week')
+    plt.tight_layout()
+    return fig
+
+def plotTop40(config, index):
     from epiweeks import Week
+    import numpy as np
+    import matplotlib.pyplot as plt
     
     pivot = 'artist'
     # we rank artists by most plays, take the top 25 and 
     # add their played tracks to the playlist.
     #pivot = config['pivot'] if 'pivot' in config else 'artist'
 
-    result = {}
     print(f'Grouping by {pivot}')
-    for r in catalog:
-        if r['track'] is None:
-            continue
-        artistid = r[pivot]['name']
-        if pivot == 'track':
-            artistid += ';;'+r['artist']['name']
-        week = Week.fromdate(datetime.strptime(r['airdate'], '%Y-%m-%dT%H:%M:%SZ'))
-        if week not in result:
-            result[week]={}
-        if artistid not in result[week]:
-            result[week][artistid]={'track':r, 'plays':set(), 'songs':set()}
-        
-        result[week][artistid]['plays'].add(r['airdate']) # count by unique timestamps. Sometimes the playlist has duplicates.
-        result[week][artistid]['songs'].add((r['artist']['name'],r['track']['name']))
-    print([w for w in result])
+    weekIds, _, _ = weeklyArtistCounts(index)
+    weeks = np.unique(weekIds)
+    print([Week.fromdate(weekStart(w)) for w in weeks])
     
-    all_results = result
     if 0:
-        all_artists = []
-        plots = {}
-        N=10
-        W=20
-        weeks = list(sorted(all_results))[-W:]
-        for w in weeks:
-            result = all_results[w]
-            topN = list(sorted(result, key=lambda x: len(result[x]['plays']), reverse=True))[:N]
-            print(topN)
-            for i,a in enumerate(topN):
-                if a not in all_artists:
-                    all_artists.append(a)
-                if a not in plots:
-                    plots[a]=[]
-                plots[a].append((w,i))
-            #ranks.append(topN)
-        y0_values = dict((k,N-v+1) for v,k in enumerate(all_artists))
-        x_values = dict([(k,v+1) for (v,k) in enumerate(weeks)])
-        import matplotlib.pyplot as plt
-        from math import isnan
-        fig, ax = plt.subplots(figsize=(12,8)) #subplot_kw=dict(axisbg='#EEEEEE'))
-        for a in plots:
-            lookup = dict(plots[a])
-            X = [x_values[w] for w in weeks] #[x_values[w] for (w,_) in plots[a]]
-            Y = [N-lookup[w] if w in lookup else float('NaN') for w in weeks] #N-v for (_,v) in plots[a]]
-            ax.plot(X, Y, 'o-')
-            for i in range(len(X)):
-                if i==0 or (not isnan(Y[i]) and isnan(Y[i-1])):
-                    ax.text(X[i],Y[i]+0.15, a, ha='center', fontsize=8)
-            ax.set_yticks(range(N+1))
-            ax.set_yticklabels(['']+[str(N-y) for y in range(N)])
+        weeklyRankFigure(weeklyRankData(index))
         plt.show()
 
-    threshold = Week.fromdate(datetime(2020,5,26))
-    summary = {}
-    from collections import Counter
-    denom = Counter()
-    for w in all_results:
-        isprior = w<threshold
-        denom[isprior]+=1
-        current = all_results[w]
-        for a in current:
-            if a not in summary:
-                summary[a]=Counter()
-            summary[a][isprior]+=len(current[a]['plays'])
-    import matplotlib.pyplot as plt
-    fig, ax = plt.subplots(figsize=(12,8)) 
-    labels = []
-    N=20
-    for i,a in enumerate(list(sorted(summary, key = lambda x: summary[x][True]+summary[x][False]))[-N:]):
-        ax.plot([2*i-0.5,2*i+0.5], [summary[a][True]/denom[True], summary[a][False]/denom[False]],'o-')
-        labels.append(a)
-        print('{}\t{}\t{}'.format(a, summary[a][True]/denom[True], summary[a][False]/denom[False]))
-    ax.set_xticks([2*i for i in range(N)])
-    ax.set_xticklabels(labels, rotation=90)
-    ax.set_ylabel('Plays per Week')
-    plt.tight_layout()
+    data = playsPerWeekData(index)
+    for a, before, after in data['artists']:
+        print('{}\t{}\t{}'.format(a, before, after))
+    playsPerWeekFigure(data)
     plt.savefig('playsPerWeek.png')
     plt.show()
 
-    if 0:
-        import mpld3
-        from math import log, ceil
+# Batch mode: the chart data is computed once from the catalog, written
+# as chartData.json, and every chart is rendered from it headlessly in a
+# process pool.
+CHARTS = {
+    'playsPerWeek.png': ('playsPerWeek', playsPerWeekFigure),
+    'weeklyRanks.png': ('weeklyRanks', weeklyRankFigure),
+    'artistTrack.png': ('artistTrack', artistTrackFigure),
+    'artistTrack.html': ('artistTrack', partial(artistTrackFigure, tooltips=True)),
+}
 
-        data = [(x,y,ctr[(x,y)]) for (x,y) in ctr]
-        x_track=[d[0] for d in data]
-        y_artist=[d[1] for d in data]
-        count = [len(d[2]) for d in data]
-        labels = [','.join(d[2]) for d in data]
-        
-        fig, ax = plt.subplots(figsize=(4,2)) #subplot_kw=dict(axisbg='#EEEEEE'))
-        scatter = ax.scatter(x_track, y_artist, s=[3*log(c+1) for c in count])
-        xint = range(min(x_track), ceil(max(x_track))+1)
-        #ax.set_xticks(xint)
-        ax.set_xlabel('Track Plays')
-        ax.set_ylabel('Artist Plays')
-        tooltip = mpld3.plugins.PointLabelTooltip(scatter, labels=labels)
-        mpld3.plugins.connect(fig, tooltip)
-        mpld3.show()
-        #plt.show()
-        #print(ctr)
+def chartData(index):
+    return {'playsPerWeek': playsPerWeekData(index),
+            'weeklyRanks': weeklyRankData(index),
+            'artistTrack': artistTrackData(index)}
 
+def headless():
+    import matplotlib
+    matplotlib.use('Agg')
+
+def renderChart(name, data, outDir):
+    import os
+    import matplotlib.pyplot as plt
+    fig = CHARTS[name][1](data)
+    path = os.path.join(outDir, name)
+    if name.endswith('.html'):
+        import mpld3
+        mpld3.save_html(fig, path)
+    else:
+        fig.savefig(path)
+    plt.close(fig)
+    return path
 
+def renderCharts(data, outDir, names=None, workers=None):
+    # Renders the named charts (all by default) into outDir, one process
+    # per chart. Each worker is only sent its chart's data.
+    from concurrent.futures import ProcessPoolExecutor
+    import os
+    os.makedirs(outDir, exist_ok=True)
+    names = list(CHARTS) if names is None else names
+    with ProcessPoolExecutor(workers, initializer=headless) as pool:
+        futures = [pool.submit(renderChart, n, data[CHARTS[n][0]], outDir) for n in names]
+        return [f.result() for f in futures]
 
 def parseArgs():
     parser = argparse.ArgumentParser('Process KEXP playlist and upload to spotify')
     parser.add_argument('--config', type=str, default='config.json', help='Config file in json format')
+    parser.add_argument('--batch', metavar='DIR', help='Write chartData.json and render every chart into DIR without a display')
+    parser.add_argument('--data', metavar='FILE', help='With --batch, render from a chartData.json written earlier instead of the catalog')
+    parser.add_argument('--charts', nargs='+', choices=sorted(CHARTS), help='With --batch, only render these charts')
+    parser.add_argument('--workers', type=int, help='With --batch, rendering processes (default: one per CPU)')
     return parser.parse_args()
 
 def main():
@@ -282,8 +246,21 @@ def main():
         config=json.load(inCfg)
     
     setEnvironment(config)
-    catalog=collectFromKEXP(config)
-    plotTop40(config, catalog)
+    if args.batch:
+        import os
+        if args.data:
+            with open(args.data, 'r', encoding='utf-8') as inData:
+                data = json.load(inData)
+        else:
+            data = chartData(PlayIndex.fromPlays(streamFromKEXP(config)))
+            os.makedirs(args.batch, exist_ok=True)
+            with open(os.path.join(args.batch, 'chartData.json'), 'w', encoding='utf-8') as outData:
+                json.dump(data, outData, separators=(',', ':'))
+        for path in renderCharts(data, args.batch, args.charts, args.workers):
+            print(path)
+        return
+    index=PlayIndex.fromPlays(streamFromKEXP(config))
+    plotTop40(config, index)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -1,13 +1,16 @@
 import json
 import sys
 import os
-import spotipy
-import spotipy.util as util
 import datetime
-import time
-import requests
-import re
 import argparse
+from aggregate import groupPivots, mergeGroups
+from catalogStore import CatalogStore
+from kexpFetch import Fetcher, formatDate, hourRange
+from metrics import metrics
+from normalize import cleanSong, songKey
+
+# spotipy (and requests, which it pulls in) are imported inside the Spotify
+# stage only, so ranking-only runs start fast and need no credentials.
 
 # Sample config:
 # Visit https://developer.spotify.com/dashboard/applications to create a
@@ -37,181 +40,349 @@ def setEnvironment(config):
             os.environ[e] = config['environment'][e]
 
 
-def formatDate(date):
-    return date.strftime("%Y-%m-%dT%H:%M:%SZ")
-
-
-def makeUrl(startdate, enddate):
-    uprint(startdate, enddate)
-    return '{}/play?begin_time={}&end_time={}&ordering=airdate'.format(
-        'https://legacy-api.kexp.org',
-        formatDate(startdate), formatDate(enddate))
-
-
-def fetchDate(start, end):
-    # TODO: this is currently only capturing the first 100 tracks of the day.
-    os.makedirs('./cache', exist_ok=True)
-    cacheFn = 'cache/{}.json'.format(start.strftime("%Y%m%d"))
-    uprint("Fetching {}".format(start.strftime("%Y-%m-%d")))
-
-    if not os.path.exists(cacheFn):
-        cachetracks = []
-        while (start < end):
-            nextUrl = makeUrl(start, start+datetime.timedelta(hours=1))
-            while nextUrl is not None:
-                uprint('\t'+nextUrl.replace('https://legacy-api.kexp.org', ''))
-                result = requests.get(nextUrl)
-                if result.ok:
-                    response = result.json()
-                    tracks = response['results']
-                    nextUrl = response['next'] if len(tracks) > 0 else None
-                    uprint(len(tracks))
-                    for t in tracks:
-                        # print(json.dumps(t))
-                        if 'track' in t:
-                            cachetracks.append(t)
-                            # print(t['airdate'])
-                else:
-                    try:
-                        result.raise_for_status()
-                    except requests.exceptions.HTTPError as err:
-                        uprint(err)
-                        sys.exit(1)
-                    # print(json.dumps(result))
-                    nextUrl = None
-            start = start + datetime.timedelta(hours=1)
-            time.sleep(1)
-            # print(formatDate(start))
-            # exit()
-
-        with open(cacheFn, 'w', encoding='utf-8') as outCache:
-            outCache.write(json.dumps(cachetracks))
-    tracks = []
-    uprint("Loading {}".format(cacheFn))
-    with open(cacheFn, 'r', encoding='utf-8') as inCache:
-        tracks = json.load(inCache)
-    uprint(len(tracks))
-    return tracks
-
-
-def collectFromKEXP(config):
+def fetchHours(hours, store, fetcher, inFlight=96):
+    # Downloads the given hours concurrently, in windows planned from the
+    # store's plays per hour of day, and stores each window as soon as it
+    # is in. Failed hours are reported once everything else is saved, so a
+    # rerun only has to fetch those.
+    failed = []
+    for start, end, tracks, err in fetcher.iterWindows(
+            hours, store.hourDensity(), inFlight):
+        if err is not None:
+            uprint(err)
+            failed += hourRange(start, end)
+            continue
+        store.storeRange(start, end, tracks)
+    if len(failed) > 0:
+        uprint("Failed to fetch {} hour(s): {}".format(
+            len(failed), ', '.join(formatDate(h) for h in sorted(failed))))
+        sys.exit(1)
+
+
+def windowDays(config):
     daysToParse = config['daysToParse'] if 'daysToParse' in config else 7
 
     today = datetime.datetime.fromordinal(
         datetime.datetime.utcnow().date().toordinal())
     start_date = today - datetime.timedelta(days=daysToParse)
-    end_date = start_date + datetime.timedelta(days=1)
+    return [start_date + datetime.timedelta(days=d)
+            for d in range(daysToParse)]
+
+
+def ensureDays(config, store, days):
+    for day in store.importJsonCache():
+        uprint("Imported cache/{}.json".format(day.strftime("%Y%m%d")))
+    missing = [h for d in days for h in store.missingHours(d)]
+    metrics.count('cache.kexp.hits', 24 * len(days) - len(missing))
+    metrics.count('cache.kexp.misses', len(missing))
+    if len(missing) > 0 and config.get('offline'):
+        uprint("Offline: {} hour(s) missing or unsettled, using what is "
+               "stored".format(len(missing)))
+    elif len(missing) > 0:
+        uprint("Fetching {} missing or unsettled hour(s)".format(
+            len(missing)))
+        daysInFlight = 1 if config.get('stream') else \
+            config.get('fetchDaysInFlight', 4)
+        log = uprint if config.get('verbose') else None
+        with Fetcher.fromConfig(config, log=log) as fetcher:
+            fetchHours(missing, store, fetcher, 24 * daysInFlight)
+
+
+def streamFromKEXP(config):
+    # Yields the window's plays one at a time, straight off the store.
+    days = windowDays(config)
+    store = CatalogStore.fromConfig(config)
+    try:
+        with metrics.stage('fetch'):
+            ensureDays(config, store, days)
+        if len(days) > 0:
+            yield from store.iterRange(
+                days[0], days[-1] + datetime.timedelta(days=1))
+    finally:
+        store.close()
+
+
+def playlistSpecs(config):
+    # The config may describe several playlists under "playlists", each a
+    # dict of playlist_name/pivot/daysToParse/topN. Keys a spec leaves out
+    # fall back to the top-level config, which on its own is one playlist.
+    base = dict((k, config[k]) for k in
+                ('playlist_name', 'pivot', 'daysToParse', 'topN')
+                if k in config)
+    return [dict(base, **spec) for spec in config.get('playlists') or [{}]]
+
+
+def widestWindow(config, specs):
+    return dict(config, daysToParse=max(
+        spec.get('daysToParse', 7) for spec in specs))
+
+
+def groupSpecs(config, specs):
+    # Streaming alternative to aggregateSpecs: the widest window's plays
+    # flow from the store one day at a time, without writing per-day
+    # summaries. Each day is grouped on its own and its counts are added
+    # into every spec whose window it falls in, so only one day's plays
+    # are held at a time.
+    days = windowDays(widestWindow(config, specs))
+    store = CatalogStore.fromConfig(config)
+    with metrics.stage('fetch'):
+        ensureDays(config, store, days)
+    with metrics.stage('aggregate', hot=True):
+        pivots = [spec['pivot'] if 'pivot' in spec else 'artist'
+                  for spec in specs]
+        firsts = [windowDays(spec)[:1] for spec in specs]
+        results = [{} for _ in specs]
+        names = [{} for _ in specs]
+        for day in days:
+            built = groupPivots(
+                store.iterRange(day, day + datetime.timedelta(days=1)),
+                sorted(set(pivots)))
+            for pivot, first, result, known in zip(pivots, firsts, results,
+                                                   names):
+                if len(first) > 0 and day >= first[0]:
+                    mergeGroups(result, built[pivot], pivot, known)
+        for pivot, result in zip(pivots, results):
+            uprint(f'Grouping by {pivot} (streaming)')
+            uprint("Groups: ", len(result))
+    store.close()
+    return results
+
+
+def aggregateSpecs(config, specs):
+    # Groups each spec's window by merging per-day pre-aggregates from the
+    # store, so only days that are new since the last run get grouped from
+    # plays. The widest window is fetched once for all of them.
+    store = CatalogStore.fromConfig(config)
+    with metrics.stage('fetch'):
+        ensureDays(config, store, windowDays(widestWindow(config, specs)))
     results = []
-    while (start_date < today):
-        results += fetchDate(start_date, end_date)
-        start_date = start_date + datetime.timedelta(days=1)
-        end_date = start_date + datetime.timedelta(days=1)
-    uprint("All results: ", len(results))
+    with metrics.stage('aggregate', hot=True):
+        for spec in specs:
+            pivot = spec['pivot'] if 'pivot' in spec else 'artist'
+            uprint(f'Grouping by {pivot}')
+            results.append(store.windowGroups(windowDays(spec), pivot))
+            uprint("Groups: ", len(results[-1]))
+    store.close()
     return results
 
 
-def updateSpotify(config, catalog):
-    result = {}
+def spotifyClient(config):
+    import spotipy
+    import spotipy.util as util
+    from spotifyResolve import spotifySession
+
+    username = config['spotify_username']
 
+    # If you don't have a cached token this will trigger a web flow.
+    # An access token obtained elsewhere can be passed in the config.
+    token = config.get('spotifyAccessToken')
+    if not token:
+        scope = 'playlist-modify-public playlist-modify-private'
+        token = util.prompt_for_user_token(username, scope)
+    if not token:
+        return None
+
+    sp = spotipy.Spotify(auth=token, requests_session=spotifySession(
+        config.get('searchWorkers', 4)))
+    if 'spotifyApiPrefix' in config:
+        sp.prefix = config['spotifyApiPrefix']
+    return sp
+
+
+def rankGroups(spec, result):
     # we rank artists by most plays, take the top 25 and
     # add their played tracks to the playlist.
-    pivot = config['pivot'] if 'pivot' in config else 'artist'
-    uprint(f'Grouping by {pivot}')
-    for r in catalog:
-        if r['track'] is None or r['artist'] is None:
-            continue
-        artistid = r[pivot]['name']
-        if pivot == 'track':
-            artistid += '; '+r['artist']['name']
-        if artistid not in result:
-            result[artistid] = {'track': r, 'plays': set(), 'songs': set()}
-        # count by unique timestamps. Sometimes the playlist has duplicates.
-        result[artistid]['plays'].add(r['airdate'])
-        result[artistid]['songs'].add(
-            (r['artist']['name'], r['track']['name']))
+    topN = spec['topN'] if 'topN' in spec else 25
+    # ties and songs are ordered by name so that the playlist comes out
+    # the same on every run and the diff sync has nothing to reorder.
+    return [(r, uniqueSongs(sorted(result[r]['songs']))) for r in
+            sorted(result, key=lambda x: (-result[x]['plays'], x))
+            [0:topN]]
+
+
+def uniqueSongs(songs):
+    # One (artist, track) per songKey, so spelling variants merged from
+    # different days are searched once.
+    seen = set()
+    unique = []
+    for a, s in songs:
+        if songKey(a, s) not in seen:
+            seen.add(songKey(a, s))
+            unique.append((a, s))
+    return unique
+
+
+def rankSpecs(specs, results):
+    # The ranked groups of every spec with their play counts, in the
+    # JSON-able form the later stages (and --ranking) work from.
+    ranking = []
+    for spec, result in zip(specs, results):
+        ranking.append({
+            'playlist_name': spec.get('playlist_name'),
+            'pivot': spec.get('pivot', 'artist'),
+            'daysToParse': spec.get('daysToParse', 7),
+            'groups': [{'name': r, 'plays': result[r]['plays'],
+                        'songs': [list(song) for song in groupSongs]}
+                       for r, groupSongs in rankGroups(spec, result)]})
+    return ranking
+
+
+def writeRanking(path, specs, results):
+    with open(path, 'w', encoding='utf-8') as outRanking:
+        json.dump(rankSpecs(specs, results), outRanking, indent=1,
+                  ensure_ascii=False)
+
+
+def collectTrackIds(groups, resolved):
+    # `groups` is one spec's ranked groups from rankSpecs.
+    from spotifyResolve import exactQuery
+
+    track_ids = []
+    for group in groups:
+        uprint(group['name'], group['plays'])
+        for a, s in group['songs']:
+            found = resolved[songKey(a, s)]
+            uprint('\t{}'.format(s))
+            if found['error'] is not None:
+                uprint("Failed: {}\n{}".format(
+                    found['query'], found['error']))
+                continue
+            if found['path'] == 'keyword':
+                uprint("\tNo search result for {}".format(
+                    exactQuery(a, cleanSong(s))))
+                uprint('\tFound track: {} ; {}'.format(*found['found']))
+            elif found['path'] == 'match' and \
+                    tuple(found['found']) != (a, cleanSong(s)):
+                uprint('\tMatched track: {} ; {}'.format(*found['found']))
+            if found['id'] is None:
+                uprint("\tNo match for {}".format(found['query']))
+            elif found['id'] not in track_ids:
+                track_ids.append(found['id'])
+            else:
+                uprint("\tskipping duplicate item for {}".format(
+                    found['query']))
+
+    # Add a bonus track. ;-)
+    bonus = "1yYzqYzzXtAKxtUIIXmYgp"
+    if bonus not in track_ids:
+        track_ids.append(bonus)
+    return track_ids
+
+
+def appliedChunks(sp, pl_id, chunks, journaled):
+    # How many of the replace-mode chunks the playlist holds: the journaled
+    # count, or one more if the crash came between applying a chunk and
+    # journaling it. Anything else means starting over.
+    from playlistSync import readPlaylist, trackUri
+
+    current, _ = readPlaylist(sp, pl_id)
+    for k in (min(journaled + 1, len(chunks)), journaled):
+        if current == [trackUri(t) for chunk in chunks[:k] for t in chunk]:
+            return k
+    return 0
+
+
+def pushPlaylist(config, sp, spec, pl_id, track_ids, journal=None):
+    # With a `journal` (this playlist's recorded progress in `entry` and
+    # record() to persist a step, see weeklyJob.py) every step is recorded
+    # as it is applied and steps already recorded are skipped, so a rerun
+    # picks up a half-applied update.
+    from playlistSync import syncPlaylist
 
     username = config['spotify_username']
-    playlist_name = config['playlist_name']
-
-    # If you don't have a cached token this will trigger a web flow.
-    scope = 'playlist-modify-public playlist-modify-private'
-    token = util.prompt_for_user_token(username, scope)
-
-    if token:
-        sp = spotipy.Spotify(auth=token)
-        playlists = sp.user_playlists(username)
-        pl_id = None
-        for r in playlists['items']:
-            if r and r['name'] == playlist_name:
-                pl_id = r['id']
-                break
-        if pl_id is None:
-            raise Exception("Can't find playlist {}".format(
-                config['playlist_name']))
-
-        track_ids = []
-        topN = config['topN'] if 'topN' in config else 25
-        for r in sorted(result, key=lambda x: len(result[x]['plays']),
-                        reverse=True)[0:topN]:
-            uprint(r, len(result[r]['plays']))
-            for a, s in result[r]['songs']:
-                uprint('\t{}'.format(s))
-                s = re.sub(r'\(feat. .*\)', '', s).strip()
-                query = "artist:{} track:{}".format(a, s)
-                try:
-                    searchResult = sp.search(query)
-                    if len(searchResult['tracks']['items']) > 0:
-                        track = searchResult['tracks']['items'][0]['id']
-                        if track not in track_ids:
-                            # pprint.pprint(searchResult['tracks']['items'][0])
-                            track_ids.append(track)
-                        else:
-                            uprint("\tskipping duplicate item for {}".format(
-                                query))
-                    else:
-                        uprint("\tNo search result for {}".format(query))
-                        # try a keyword search instead
-                        a_scrub = a
-                        if 'feat.' in a_scrub.lower():
-                            a_scrub = a_scrub[:a_scrub.lower().index('feat.')]
-                        a_scrub = a_scrub.replace('&', '')
-                        s_scrub = s.replace('&', '')
-                        query = "{} {}".format(a_scrub, s_scrub)
-                        searchResult = sp.search(query)
-                        if (len(searchResult['tracks']['items']) > 0):
-                            track = searchResult['tracks']['items'][0]
-                            if track['id'] not in track_ids:
-                                uprint('\tFound track: {} ; {}'.format(
-                                    track['artists'][0]['name'], track['name'])
-                                    )
-                                track_ids.append(track['id'])
-                            else:
-                                uprint("\tskipping duplicate item for {}".
-                                      format(query))
-                        else:
-                            uprint("\t** No fallback result either.")
-                except Exception as e:
-                    uprint("Failed: {}\n{}".format(query, e))
-
-        # Add a bonus track. ;-)
-        bonus = "1yYzqYzzXtAKxtUIIXmYgp"
-        if bonus not in track_ids:
-            track_ids.append(bonus)
-        uprint('Pushing {} tracks'.format(len(track_ids)))
-
-        sp.user_playlist_replace_tracks(username, pl_id, track_ids[0:100])
-        track_ids = track_ids[100:]
-
-        while len(track_ids) > 0:
-            sp.user_playlist_add_tracks(username, pl_id, track_ids[0:100])
-            track_ids = track_ids[100:]
-
-        playlist_description = 'Top tracks on KEXP, {} days ending {}. ' \
-            'Become an Amplifier at KEXP.org'. \
-            format(config['daysToParse'],
-                   datetime.datetime.utcnow().strftime('%x'))
+    uprint('Pushing {} tracks to {}'.format(
+        len(track_ids), spec['playlist_name']))
+    metrics.count('spotify.tracks_pushed', len(track_ids))
+
+    dryRun = config.get('dryRun', False)
+    journal = None if dryRun else journal
+    done = {} if journal is None else journal.entry
+    with metrics.stage('playlist'):
+        if config.get('syncMode', 'diff') == 'diff':
+            # a rerun reads the playlist again and only plans what is left
+            if not done.get('synced'):
+                syncPlaylist(sp, pl_id, track_ids, dryRun=dryRun, log=uprint)
+                if journal is not None:
+                    journal.record(synced=True)
+        elif not dryRun:
+            chunks = [track_ids[i:i + 100]
+                      for i in range(0, len(track_ids), 100)]
+            start = 0
+            if done.get('chunks', 0) > 0:
+                start = appliedChunks(sp, pl_id, chunks, done['chunks'])
+                uprint('Resuming at chunk {} of {}'.format(
+                    start + 1, len(chunks)))
+            for i in range(start, len(chunks)):
+                if i == 0:
+                    sp.user_playlist_replace_tracks(username, pl_id,
+                                                    chunks[i])
+                else:
+                    sp.user_playlist_add_tracks(username, pl_id, chunks[i])
+                if journal is not None:
+                    journal.record(chunks=i + 1)
+
+    playlist_description = 'Top tracks on KEXP, {} days ending {}. ' \
+        'Become an Amplifier at KEXP.org'. \
+        format(spec.get('daysToParse', 7),
+               datetime.datetime.utcnow().strftime('%x'))
+    if dryRun:
+        uprint('Dry run, not updating playlist: {}'.format(
+            playlist_description))
+    elif not done.get('described'):
         sp.user_playlist_change_details(username, pl_id,
                                         description=playlist_description)
+        if journal is not None:
+            journal.record(described=True)
+
+
+def findPlaylists(config, sp, specs):
+    # {playlist name: id} for every spec's playlist.
+    playlists = sp.user_playlists(config['spotify_username'])
+    pl_ids = {}
+    for r in playlists['items']:
+        if r and r['name'] not in pl_ids:
+            pl_ids[r['name']] = r['id']
+    for spec in specs:
+        if spec['playlist_name'] not in pl_ids:
+            raise Exception("Can't find playlist {}".format(
+                spec['playlist_name']))
+    return pl_ids
+
+
+def resolveRanking(config, sp, ranking):
+    # One de-duplicated search pass over the songs of every ranked spec.
+    # Returns {songKey: resolution}.
+    from spotifyResolve import ResolutionCache, resolveSongs
+
+    songs = uniqueSongs(tuple(song) for entry in ranking
+                        for group in entry['groups']
+                        for song in group['songs'])
+    cache = ResolutionCache.fromConfig(config)
+    with metrics.stage('search'):
+        resolved = resolveSongs(sp, songs,
+                                config.get('searchWorkers', 4), cache,
+                                config.get('matchLimit', 20),
+                                config.get('matchThreshold', 0.8))
+    cache.close()
+    return dict((songKey(*song), r) for song, r in zip(songs, resolved))
+
+
+def updatePlaylists(config, specs, results):
+    # One login, one playlist lookup and one de-duplicated search pass for
+    # every spec, then each playlist is synced in turn.
+    username = config['spotify_username']
+
+    sp = spotifyClient(config)
+    if sp is not None:
+        pl_ids = findPlaylists(config, sp, specs)
+        ranking = rankSpecs(specs, results)
+        resolved = resolveRanking(config, sp, ranking)
+
+        for spec, entry in zip(specs, ranking):
+            uprint('== {} =='.format(spec['playlist_name']))
+            track_ids = collectTrackIds(entry['groups'], resolved)
+            pushPlaylist(config, sp, spec, pl_ids[spec['playlist_name']],
+                         track_ids)
     else:
         uprint("Can't get token for", username)
 
@@ -221,6 +392,26 @@ def parseArgs():
         'Process KEXP playlist and upload to spotify')
     parser.add_argument('--config', type=str, default='config.json',
                         help='Config file in json format')
+    parser.add_argument('--stream', action='store_true',
+                        help='Fetch one day at a time and stream plays into '
+                        'the grouping; keeps memory flat for long windows')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='Report the planned playlist changes without '
+                        'applying them')
+    parser.add_argument('--ranking', type=str, default=None,
+                        help='Write the ranked groups with play counts to '
+                        'this JSON file and skip Spotify')
+    parser.add_argument('--offline', action='store_true',
+                        help='Rank only what is already in the catalog '
+                        'store; no KEXP requests')
+    parser.add_argument('--verbose', action='store_true',
+                        help='Log every KEXP request')
+    parser.add_argument('--metrics', type=str, default=None,
+                        help='Write the JSON metrics summary to this file '
+                        'instead of stdout')
+    parser.add_argument('--profile', choices=['cprofile', 'tracemalloc'],
+                        help='Profile the hot stages (cProfile dumps go to '
+                        'profile/)')
     return parser.parse_args()
 
 
@@ -229,9 +420,29 @@ def main():
     with open(args.config, 'r', encoding='utf-8') as inCfg:
         config = json.load(inCfg)
 
+    if args.stream:
+        config['stream'] = True
+    if args.dry_run:
+        config['dryRun'] = True
+    if args.verbose:
+        config['verbose'] = True
+    if args.offline:
+        config['offline'] = True
+    metrics.profile = args.profile
+
     setEnvironment(config)
-    catalog = collectFromKEXP(config)
-    updateSpotify(config, catalog)
+    specs = playlistSpecs(config)
+    with metrics.stage('total'):
+        if config.get('stream'):
+            results = groupSpecs(config, specs)
+        else:
+            results = aggregateSpecs(config, specs)
+        if args.ranking:
+            writeRanking(args.ranking, specs, results)
+            uprint('Wrote ranking to {}'.format(args.ranking))
+        else:
+            updatePlaylists(config, specs, results)
+    metrics.write(args.metrics)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,295 @@
+import argparse
+import datetime
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+
+from aggregate import PIVOTS, groupKey, groupPivots
+from catalogStore import CatalogStore, dayKey
+from normalize import artistKey, songKey
+from playIndex import Interner
+from processCatalog import setEnvironment, uprint
+
+# Local HTTP/JSON service answering ranking questions over the catalog
+# store without regrouping it:
+#
+#   python queryService.py --port 8765
+#   curl 'localhost:8765/top?pivot=artist&days=30&n=10'
+#   curl 'localhost:8765/top?pivot=track&from=2024-03-01&to=2024-03-31'
+#   curl 'localhost:8765/counts?pivot=artist&name=Radiohead&days=90'
+#   curl 'localhost:8765/status'
+#
+# Plays are counted per group and day (by unique airdate, as everywhere
+# else) into prefix sums over days, so any range is one vector subtraction.
+# The store is polled every `refresh` seconds; only days whose hours were
+# (re)stored since the last poll are recounted. Fill the store with
+# processCatalog.py or backfill.py.
+
+
+class WindowIndex:
+    # Per-day play counts for one pivot, kept as prefix sums: row d of
+    # `prefix` holds each group's plays before day d. Rows and columns
+    # grow with spare capacity as days and groups are added.
+    def __init__(self):
+        self.names = Interner()
+        self.nDays = 0
+        self.prefix = np.zeros((8, 64), dtype=np.int64)
+
+    def grow(self, rows, cols):
+        r, c = self.prefix.shape
+        if rows <= r and cols <= c:
+            return
+        grown = np.zeros((max(rows, 2 * r if rows > r else r),
+                          max(cols, 2 * c if cols > c else c)),
+                         dtype=np.int64)
+        grown[:self.nDays + 1, :c] = self.prefix[:self.nDays + 1]
+        self.prefix = grown
+
+    def setDay(self, d, counts):
+        # Replaces day d's counts with `counts` ({group key: (name,
+        # plays)}); groups are named after the first spelling seen.
+        ids = [self.names.intern(name, key)
+               for key, (name, _) in counts.items()]
+        self.grow(d + 2, len(self.names))
+        if d >= self.nDays:
+            # days up to d are new (and empty until set)
+            self.prefix[self.nDays + 1:d + 2] = self.prefix[self.nDays]
+            self.nDays = d + 1
+        row = np.zeros(self.prefix.shape[1], dtype=np.int64)
+        row[ids] = [n for _, n in counts.values()]
+        delta = row - (self.prefix[d + 1] - self.prefix[d])
+        self.prefix[d + 1:self.nDays + 1] += delta
+
+    def totals(self, first, last):
+        # Plays per group over days first..last (inclusive).
+        return self.prefix[last + 1, :len(self.names)] - \
+            self.prefix[first, :len(self.names)]
+
+    def top(self, first, last, n):
+        totals = self.totals(first, last)
+        played = np.flatnonzero(totals)
+        if len(played) > n:
+            # everything tied with the n-th count, ordered by name below
+            cut = np.partition(totals[played], len(played) - n)[
+                len(played) - n]
+            played = played[totals[played] >= cut]
+        ranked = sorted(played, key=lambda g: (-totals[g], self.names[g]))
+        return [(self.names[g], int(totals[g])) for g in ranked[:n]]
+
+    def daily(self, key, first, last):
+        g = self.names.get(key)
+        if g is None:
+            return None
+        return np.diff(self.prefix[first:last + 2, g]).tolist()
+
+
+class CatalogIndex:
+    # The in-memory index of the whole catalog store, one WindowIndex per
+    # pivot, all sharing the day axis that starts at `day0`.
+    def __init__(self, config):
+        self.config = config
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.day0 = None
+        self.signatures = {}
+        self.pivots = dict((p, WindowIndex()) for p in PIVOTS)
+        self.refreshedAt = None
+
+    def refresh(self):
+        # Recounts the days that are new or were re-stored since the last
+        # refresh and returns how many there were. A day earlier than the
+        # current first day means a rebuild from scratch.
+        store = CatalogStore.fromConfig(self.config)
+        try:
+            signatures = store.daySignatures()
+            changed = sorted(d for d in signatures
+                             if self.signatures.get(d) != signatures[d])
+            rebuild = len(changed) > 0 and self.day0 is not None and \
+                changed[0] < self.day0
+            if rebuild:
+                changed = sorted(signatures)
+            counted = []
+            for day in changed:
+                built = groupPivots(
+                    store.iterRange(day, day + datetime.timedelta(days=1)))
+                counted.append((day, dict(
+                    (p, dict((groupKey(p, k, g), (k, g['plays']))
+                             for k, g in built[p].items()))
+                    for p in PIVOTS)))
+        finally:
+            store.close()
+        with self.lock:
+            if rebuild:
+                self.reset()
+            for day, counts in counted:
+                if self.day0 is None:
+                    self.day0 = day
+                d = (day - self.day0).days
+                for p in PIVOTS:
+                    self.pivots[p].setDay(d, counts[p])
+                self.signatures[day] = signatures[day]
+            self.refreshedAt = time.time()
+        return len(counted)
+
+    def dayRange(self, q):
+        # first..last day indices (inclusive) from from=/to= dates or the
+        # last days=N days indexed, clipped to the index.
+        nDays = self.pivots[PIVOTS[0]].nDays
+        if nDays == 0:
+            raise ValueError('The catalog store is empty')
+        if 'days' in q:
+            last = nDays - 1
+            first = last - int(q['days']) + 1
+        else:
+            parse = lambda v: (datetime.datetime.strptime(v, "%Y-%m-%d") -
+                               self.day0).days
+            first = parse(q['from']) if 'from' in q else 0
+            last = parse(q['to']) if 'to' in q else nDays - 1
+        first = max(first, 0)
+        last = min(last, nDays - 1)
+        if first > last:
+            raise ValueError('Empty date range')
+        return first, last
+
+    def day(self, d):
+        return dayKey(self.day0 + datetime.timedelta(days=d))
+
+    def pivot(self, q):
+        pivot = q.get('pivot', 'artist')
+        if pivot not in self.pivots:
+            raise ValueError('Unknown pivot {}'.format(pivot))
+        return pivot
+
+    def top(self, q):
+        with self.lock:
+            pivot = self.pivot(q)
+            first, last = self.dayRange(q)
+            ranked = self.pivots[pivot].top(first, last, int(q.get('n', 25)))
+            return {'pivot': pivot, 'from': self.day(first),
+                    'to': self.day(last),
+                    'top': [{'name': k, 'plays': n} for k, n in ranked]}
+
+    def counts(self, q):
+        with self.lock:
+            pivot = self.pivot(q)
+            first, last = self.dayRange(q)
+            if pivot == 'track':
+                # track groups are named "title; artist"
+                title, _, artist = q['name'].rpartition('; ')
+                key = songKey(artist, title)
+            else:
+                key = artistKey(q['name'])
+            daily = self.pivots[pivot].daily(key, first, last)
+            if daily is None:
+                raise KeyError(q['name'])
+            return {'pivot': pivot,
+                    'name': self.pivots[pivot].names[
+                        self.pivots[pivot].names.get(key)],
+                    'from': self.day(first), 'to': self.day(last),
+                    'plays': sum(daily),
+                    'daily': [[self.day(first + i), n]
+                              for i, n in enumerate(daily)]}
+
+    def status(self, q):
+        with self.lock:
+            nDays = self.pivots[PIVOTS[0]].nDays
+            return {'from': self.day(0) if nDays else None,
+                    'to': self.day(nDays - 1) if nDays else None,
+                    'days': nDays,
+                    'groups': dict((p, len(w.names))
+                                   for p, w in self.pivots.items()),
+                    'refreshedAt': self.refreshedAt}
+
+
+class QueryServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, index):
+        super().__init__(address, QueryHandler)
+        self.index = index
+
+
+class QueryHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def reply(self, body, status=200):
+        data = json.dumps(body, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        route = {'/top': self.server.index.top,
+                 '/counts': self.server.index.counts,
+                 '/status': self.server.index.status}.get(url.path)
+        if route is None:
+            return self.reply({'error': 'Not found'}, 404)
+        q = dict((k, v[0]) for k, v in parse_qs(url.query).items())
+        start = time.perf_counter()
+        try:
+            result = route(q)
+        except KeyError as e:
+            return self.reply({'error': 'Not found: {}'.format(e)}, 404)
+        except ValueError as e:
+            return self.reply({'error': str(e)}, 400)
+        result['ms'] = round(1000 * (time.perf_counter() - start), 3)
+        self.reply(result)
+
+
+def refreshLoop(index, seconds):
+    while True:
+        time.sleep(seconds)
+        try:
+            n = index.refresh()
+        except Exception as e:
+            uprint('Refresh failed: {}'.format(e))
+            continue
+        if n > 0:
+            uprint('Indexed {} new or updated day(s)'.format(n))
+
+
+def parseArgs():
+    parser = argparse.ArgumentParser(
+        'Serve top-N queries over the KEXP catalog store')
+    parser.add_argument('--config', type=str, default='config.json',
+                        help='Config file in json format')
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--refresh', type=float, default=60,
+                        help='Seconds between checks for newly stored days')
+    return parser.parse_args()
+
+
+def main():
+    args = parseArgs()
+    with open(args.config, 'r', encoding='utf-8') as inCfg:
+        config = json.load(inCfg)
+
+    setEnvironment(config)
+    index = CatalogIndex(config)
+    started = time.perf_counter()
+    uprint('Indexed {} day(s) in {:.1f}s'.format(
+        index.refresh(), time.perf_counter() - started))
+    threading.Thread(target=refreshLoop, args=(index, args.refresh),
+                     daemon=True).start()
+    server = QueryServer((args.host, args.port), index)
+    uprint('Serving on http://{}:{}'.format(args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,293 @@
+import argparse
+import datetime
+import itertools
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+from benchmark import recordRun, reportChild, runChildProcess
+
+# Scale harness for the grouping and ranking stages on multi-year catalogs.
+# Synthetic KEXP day files are written into <workdir>/cache/ (the
+# YYYYMMDD.json files processCatalog imports), then each stage runs in its
+# own child process so its wall clock and peak memory are measured alone:
+#
+#   python scaleBench.py --days 365 1095
+#   python scaleBench.py --days 3650 --plays-per-day 600 --check
+#
+#   import     cache/*.json -> catalog store
+#   group      streaming per-day grouping over the window, both pivots
+#              (--stream)
+#   aggregate  per-day pre-aggregates merged over the window, both pivots,
+#              cold (day summaries built) then warm
+#   chart      the plotTop40 / plotChart --batch chart data
+#
+# group and aggregate also time the ranking (rankGroups) of their result.
+# Memory is reported over a child that only imports the modules. Results
+# are appended to scaleBench.json; --check fails the run if a stage is
+# over its per-play budget in THRESHOLDS, or grew by more than --tolerance
+# since the last run with the same settings.
+
+STAGES = ('import', 'group', 'aggregate', 'aggregateWarm', 'chart')
+PIVOTS = ('artist', 'track')
+
+# Per-stage budgets: microseconds and bytes of peak memory per play.
+THRESHOLDS = {
+    'import': {'us_per_play': 40, 'bytes_per_play': 400},
+    'group': {'us_per_play': 40, 'bytes_per_play': 2500},
+    'aggregate': {'us_per_play': 100, 'bytes_per_play': 2000},
+    'aggregateWarm': {'us_per_play': 40, 'bytes_per_play': 2000},
+    'chart': {'us_per_play': 30, 'bytes_per_play': 2500},
+}
+
+
+class Catalog:
+    # Deterministic synthetic plays: artists drawn by Zipf popularity, each
+    # with a Zipf-distributed set of songs, air breaks without artist or
+    # track, repeated records (the same airdate twice) and the odd variant
+    # spelling ("The Artist 3", "Song 1 (feat. Guest)").
+    def __init__(self, artists=20000, songs=40, exponent=1.1, seed=0):
+        self.seed = seed
+        self.artistNames = ['Artist {}'.format(a) for a in range(artists)]
+        self.artistWeights = list(itertools.accumulate(
+            1 / (r + 1) ** exponent for r in range(artists)))
+        self.songWeights = list(itertools.accumulate(
+            1 / (r + 1) ** exponent for r in range(songs)))
+
+    def day(self, day, playsPerDay=360, nullRate=0.05, duplicateRate=0.02,
+            variantRate=0.03):
+        rng = random.Random('{}:{}'.format(self.seed, day.toordinal()))
+        gap = 86400 / playsPerDay
+        n = int(playsPerDay * 1.2)
+        artists = rng.choices(range(len(self.artistNames)),
+                              cum_weights=self.artistWeights, k=n)
+        songs = rng.choices(range(len(self.songWeights)),
+                            cum_weights=self.songWeights, k=n)
+        plays = []
+        t = 0.0
+        for a, s in zip(artists, songs):
+            t += rng.uniform(0.5 * gap, 1.5 * gap)
+            if t >= 86400:
+                break
+            airdate = (day + datetime.timedelta(seconds=int(t))).strftime(
+                "%Y-%m-%dT%H:%M:%SZ")
+            if rng.random() < nullRate:
+                plays.append({'airdate': airdate, 'artist': None,
+                              'track': None,
+                              'playtype': {'name': 'Air break'}})
+                continue
+            artist = self.artistNames[a]
+            track = 'Song {} of {}'.format(s, artist)
+            if rng.random() < variantRate:
+                artist = 'The ' + artist
+                track += ' (feat. Guest {})'.format(rng.randint(0, 9))
+            play = {
+                'airdate': airdate,
+                'artist': {'artistid': a, 'name': artist},
+                'track': {'name': track},
+                'release': {'name': 'Release {} of {}'.format(s % 3, artist)},
+                'label': {'name': 'Label {}'.format(a % 97)},
+                'playtype': {'name': 'Media play'}}
+            plays.append(play)
+            if rng.random() < duplicateRate:
+                plays.append(dict(play))
+        return plays
+
+
+def writeDays(cacheDir, days, catalog, playsPerDay):
+    # Writes one cache/YYYYMMDD.json per day; returns the plays written.
+    os.makedirs(cacheDir, exist_ok=True)
+    total = 0
+    for day in days:
+        plays = catalog.day(day, playsPerDay)
+        with open(os.path.join(cacheDir, day.strftime("%Y%m%d") + '.json'),
+                  'w', encoding='utf-8') as outDay:
+            json.dump(plays, outDay)
+        total += len(plays)
+    return total
+
+
+def specs(days):
+    return [{'pivot': pivot, 'daysToParse': days, 'topN': 100}
+            for pivot in PIVOTS]
+
+
+def rankAll(config, results):
+    from processCatalog import rankGroups
+    from metrics import metrics
+
+    with metrics.stage('rank'):
+        for spec, result in zip(specs(config['daysToParse']), results):
+            rankGroups(spec, result)
+    return sum(len(r) for r in results)
+
+
+def runStage(stage, config):
+    # One stage, in this (child) process. Returns what it counted. The
+    # 'baseline' stage only imports the modules, so its peak memory is what
+    # every stage starts from.
+    from catalogStore import CatalogStore
+    import processCatalog
+
+    if stage == 'import':
+        store = CatalogStore.fromConfig(config)
+        days = len(store.importJsonCache())
+        plays = store.db.execute('SELECT COUNT(*) FROM plays').fetchone()[0]
+        store.close()
+        return {'days': days, 'stored_plays': plays}
+    if stage == 'group':
+        return {'groups': rankAll(config, processCatalog.groupSpecs(
+            config, specs(config['daysToParse'])))}
+    if stage in ('aggregate', 'aggregateWarm'):
+        return {'groups': rankAll(config, processCatalog.aggregateSpecs(
+            config, specs(config['daysToParse'])))}
+    if stage == 'chart':
+        from playIndex import PlayIndex
+        from plotChart import chartData
+        data = chartData(PlayIndex.fromPlays(
+            processCatalog.streamFromKEXP(config)))
+        return {'artists': len(data['artistTrack'])}
+    return {}
+
+
+def runChild(stage, configPath):
+    # Runs one stage and prints one SCALE line.
+    with open(configPath, 'r', encoding='utf-8') as inCfg:
+        config = json.load(inCfg)
+    reportChild('SCALE', lambda: runStage(stage, config))
+
+
+def runOnce(workdir, configPath, stage):
+    return runChildProcess(__file__, [stage, configPath], workdir, 'SCALE')
+
+
+def runScenario(days, args):
+    workdir = tempfile.mkdtemp(prefix='kexp-scale-')
+    today = datetime.datetime.fromordinal(
+        datetime.datetime.utcnow().date().toordinal())
+    window = [today - datetime.timedelta(days=days - d)
+              for d in range(days)]
+    catalog = Catalog(args.artists, args.songs, args.exponent, args.seed)
+    start = time.perf_counter()
+    plays = writeDays(os.path.join(workdir, 'cache'), window, catalog,
+                      args.plays_per_day)
+    generated = time.perf_counter() - start
+
+    config = {'daysToParse': days, 'offline': True}
+    configPath = os.path.join(workdir, 'config.json')
+    with open(configPath, 'w', encoding='utf-8') as outCfg:
+        json.dump(config, outCfg)
+
+    baseline = runOnce(workdir, configPath, 'baseline')['maxrss_kb']
+    scenario = {'days': days, 'plays': plays,
+                'generate_wall': round(generated, 3),
+                'cache_bytes': sum(
+                    os.path.getsize(os.path.join(workdir, 'cache', f))
+                    for f in os.listdir(os.path.join(workdir, 'cache'))),
+                'baseline_kb': baseline, 'stages': {}}
+    for stage in STAGES:
+        r = runOnce(workdir, configPath, stage)
+        scenario['stages'][stage] = {
+            'wall': round(r['wall'], 3),
+            'maxrss_kb': r['maxrss_kb'],
+            'peak_kb': max(r['maxrss_kb'] - baseline, 0),
+            'us_per_play': round(1e6 * r['wall'] / max(plays, 1), 2),
+            'bytes_per_play': round(
+                1024 * max(r['maxrss_kb'] - baseline, 0) / max(plays, 1), 1),
+            'counts': r['result'],
+            'substages': r['metrics']['stages']}
+    if not args.keep:
+        shutil.rmtree(workdir)
+    else:
+        scenario['workdir'] = workdir
+    return scenario
+
+
+def checkRegressions(previous, scenarios, tolerance):
+    # Flags stages over their THRESHOLDS budget, and stages whose time or
+    # memory grew by more than `tolerance` over the latest earlier run
+    # with the same parameters.
+    problems = []
+    for s in scenarios:
+        old = previous.get(s['days'])
+        for stage, r in s['stages'].items():
+            for key, limit in THRESHOLDS.get(stage, {}).items():
+                if r[key] > limit:
+                    problems.append('{}d {} {}: {} over budget {}'.format(
+                        s['days'], stage, key, r[key], limit))
+            if old is None or stage not in old['stages']:
+                continue
+            for key in ('wall', 'peak_kb'):
+                was = old['stages'][stage][key]
+                if r[key] > was * (1 + tolerance):
+                    problems.append('{}d {} {}: {} -> {}'.format(
+                        s['days'], stage, key, was, r[key]))
+    return problems
+
+
+def printScenario(s):
+    print('{:>5}d {:>9} plays  {:.1f} MB of day files  (generated in '
+          '{:.1f}s)'.format(s['days'], s['plays'], s['cache_bytes'] / 2**20,
+                            s['generate_wall']))
+    for stage, r in s['stages'].items():
+        print('       {:<14} {:8.2f}s {:8d} KB  {:7.2f} us/play  '
+              '{:7.1f} B/play  {}'.format(
+                  stage, r['wall'], r['peak_kb'], r['us_per_play'],
+                  r['bytes_per_play'],
+                  ' '.join('{} {}'.format(k, v)
+                           for k, v in r['counts'].items())))
+
+
+def parseArgs():
+    parser = argparse.ArgumentParser(
+        'Time grouping and ranking on large synthetic KEXP catalogs')
+    parser.add_argument('--days', type=int, nargs='+', default=[365, 1095],
+                        help='Catalog sizes in days, one scenario each')
+    parser.add_argument('--plays-per-day', type=int, default=360,
+                        help='Average plays per day (KEXP airs about 360)')
+    parser.add_argument('--artists', type=int, default=20000,
+                        help='Distinct artists to draw from')
+    parser.add_argument('--songs', type=int, default=40,
+                        help='Distinct songs per artist')
+    parser.add_argument('--exponent', type=float, default=1.1,
+                        help='Zipf exponent of artist and song popularity')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--keep', action='store_true',
+                        help='Keep the working directories')
+    parser.add_argument('--results', type=str, default='scaleBench.json',
+                        help='File the results are appended to')
+    parser.add_argument('--check', action='store_true',
+                        help='Exit non-zero if a stage is over budget or '
+                        'regressed')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='Allowed relative growth in time and memory')
+    parser.add_argument('--child', nargs=2, help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+def main():
+    args = parseArgs()
+    if args.child:
+        runChild(*args.child)
+        return
+
+    params = {k: getattr(args, k) for k in (
+        'plays_per_day', 'artists', 'songs', 'exponent', 'seed')}
+    scenarios = []
+    for days in args.days:
+        scenario = runScenario(days, args)
+        printScenario(scenario)
+        scenarios.append(scenario)
+
+    problems = recordRun(args.results, params, scenarios, checkRegressions,
+                         args.tolerance)
+    if args.check and len(problems) > 0:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
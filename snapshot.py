@@ -0,0 +1,240 @@
+import argparse
+import datetime
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+import zipfile
+
+from catalogStore import CatalogStore, hourKey
+from processCatalog import playlistSpecs, uprint, widestWindow
+from spotifyResolve import ResolutionCache
+
+# Packs the catalog store and the Spotify resolution cache into a single
+# snapshot file, so a runner that starts from a clean checkout can restore
+# them and only fetch and search what is new:
+#
+#   python snapshot.py import kexp-snapshot.zip
+#   python processCatalog.py
+#   python snapshot.py export kexp-snapshot.zip
+#
+# The snapshot is a zip holding a manifest (format version, creation time,
+# stored day range, sha256 and size of every member) and the two SQLite
+# databases, compacted and deflated. Per-day aggregates are dropped, they
+# are rebuilt on demand; raw KEXP records (keepRawPlays) are not included.
+# Unless told otherwise, the export keeps the days the widest playlist
+# window needs, plus MARGIN_DAYS.
+
+FORMAT = 'kexp-snapshot'
+VERSION = 1
+MARGIN_DAYS = 7
+
+
+class SnapshotError(Exception):
+    pass
+
+
+def sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as inFile:
+        for block in iter(lambda: inFile.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def copyDb(source, target):
+    # Consistent copy of a live database through the backup API.
+    src = sqlite3.connect(source)
+    dst = sqlite3.connect(target)
+    with dst:
+        src.backup(dst)
+    src.close()
+    return dst
+
+
+def exportSnapshot(config, path, days=None):
+    # Writes the snapshot to `path`. With `days`, only the last that many
+    # days of plays are kept.
+    catalogPath = config.get('catalogStore', 'cache/catalog.sqlite')
+    resolvePath = config.get('resolveCache', 'cache/resolve.sqlite')
+    # opening them brings older stores up to date before they are copied
+    CatalogStore.fromConfig(config).close()
+    ResolutionCache.fromConfig(config).close()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        catalog = copyDb(catalogPath, os.path.join(tmp, 'catalog.sqlite'))
+        with catalog:
+            if days is not None:
+                today = datetime.datetime.fromordinal(
+                    datetime.datetime.utcnow().date().toordinal())
+                cutoff = today - datetime.timedelta(days=days)
+                catalog.execute('DELETE FROM plays WHERE airdate < ?',
+                                (hourKey(cutoff),))
+                catalog.execute('DELETE FROM hours WHERE hour < ?',
+                                (hourKey(cutoff),))
+                catalog.execute(
+                    'DELETE FROM names WHERE id NOT IN ('
+                    ' SELECT artist FROM plays WHERE artist IS NOT NULL'
+                    ' UNION SELECT track FROM plays WHERE track IS NOT NULL)')
+            catalog.execute('DELETE FROM day_summaries')
+        first, last = catalog.execute(
+            'SELECT MIN(hour), MAX(hour) FROM hours').fetchone()
+        catalog.execute('VACUUM')
+        catalog.close()
+        resolve = copyDb(resolvePath, os.path.join(tmp, 'resolve.sqlite'))
+        resolve.execute('VACUUM')
+        resolve.close()
+
+        members = ['catalog.sqlite', 'resolve.sqlite']
+        manifest = {
+            'format': FORMAT,
+            'version': VERSION,
+            'createdAt': time.time(),
+            'first': first[:len('YYYY-MM-DD')] if first else None,
+            'last': last[:len('YYYY-MM-DD')] if last else None,
+            'files': dict((m, {
+                'sha256': sha256(os.path.join(tmp, m)),
+                'bytes': os.path.getsize(os.path.join(tmp, m))})
+                for m in members)}
+        partial = path + '.partial'
+        with zipfile.ZipFile(partial, 'w', zipfile.ZIP_DEFLATED,
+                             compresslevel=9) as outZip:
+            outZip.writestr('manifest.json', json.dumps(manifest, indent=1))
+            for m in members:
+                outZip.write(os.path.join(tmp, m), m)
+        os.replace(partial, path)
+    return manifest
+
+
+def readManifest(snapshot):
+    try:
+        manifest = json.loads(snapshot.read('manifest.json'))
+    except (KeyError, ValueError):
+        raise SnapshotError('No manifest, not a snapshot')
+    if manifest.get('format') != FORMAT:
+        raise SnapshotError('Not a snapshot: {}'.format(
+            manifest.get('format')))
+    if manifest.get('version') != VERSION:
+        raise SnapshotError('Snapshot version {} is not supported '
+                            '(expected {})'.format(manifest.get('version'),
+                                                   VERSION))
+    return manifest
+
+
+def mergeCatalog(config, source):
+    # Copies into the local store every hour that is missing there or was
+    # fetched earlier than in the snapshot.
+    store = CatalogStore.fromConfig(config)
+    snapshot = CatalogStore(source, settle=store.settle)
+    local = dict(store.db.execute('SELECT hour, fetched_at FROM hours'))
+    merged = 0
+    for hour, fetchedAt in snapshot.db.execute(
+            'SELECT hour, fetched_at FROM hours ORDER BY hour').fetchall():
+        if local.get(hour, -1) >= fetchedAt:
+            continue
+        start = datetime.datetime.strptime(hour, "%Y-%m-%dT%H")
+        store.addHour(start, snapshot.loadRange(
+            start, start + datetime.timedelta(hours=1)), fetchedAt)
+        merged += 1
+    snapshot.close()
+    store.close()
+    return merged
+
+
+def mergeResolve(config, source):
+    # Keeps the newer resolution of every song.
+    cache = ResolutionCache.fromConfig(config)
+    with cache.db:
+        cache.db.execute('ATTACH DATABASE ? AS snapshot', (source,))
+        n = cache.db.execute(
+            'INSERT OR REPLACE INTO resolution'
+            ' SELECT s.* FROM snapshot.resolution s'
+            ' LEFT JOIN resolution r'
+            ' ON r.artist = s.artist AND r.track = s.track'
+            ' WHERE r.resolved_at IS NULL OR r.resolved_at < s.resolved_at'
+        ).rowcount
+    cache.db.execute('DETACH DATABASE snapshot')
+    cache.close()
+    return n
+
+
+def importSnapshot(config, path):
+    # Verifies the snapshot and restores it. Databases that don't exist
+    # locally are moved into place; existing ones are merged, newest wins.
+    catalogPath = config.get('catalogStore', 'cache/catalog.sqlite')
+    resolvePath = config.get('resolveCache', 'cache/resolve.sqlite')
+    # unpacked next to the store so restoring is a rename
+    os.makedirs(os.path.dirname(catalogPath) or '.', exist_ok=True)
+    with tempfile.TemporaryDirectory(
+            dir=os.path.dirname(catalogPath) or '.') as tmp:
+        with zipfile.ZipFile(path) as snapshot:
+            manifest = readManifest(snapshot)
+            for m, expected in manifest['files'].items():
+                snapshot.extract(m, tmp)
+                if sha256(os.path.join(tmp, m)) != expected['sha256']:
+                    raise SnapshotError('Checksum mismatch for {}'.format(m))
+        for m, target, merge in (
+                ('catalog.sqlite', catalogPath, mergeCatalog),
+                ('resolve.sqlite', resolvePath, mergeResolve)):
+            source = os.path.join(tmp, m)
+            if not os.path.exists(target):
+                os.makedirs(os.path.dirname(target) or '.', exist_ok=True)
+                shutil.move(source, target)
+                uprint('Restored {}'.format(target))
+            else:
+                uprint('Merged {} hours/songs into {}'.format(
+                    merge(config, source), target))
+    return manifest
+
+
+def parseArgs():
+    parser = argparse.ArgumentParser(
+        'Export or import a snapshot of the KEXP catalog and Spotify caches')
+    parser.add_argument('--config', type=str, default='config.json',
+                        help='Config file in json format')
+    commands = parser.add_subparsers(dest='command', required=True)
+    exportCmd = commands.add_parser('export', help='Write a snapshot')
+    exportCmd.add_argument('path', help='Snapshot file to write')
+    exportCmd.add_argument('--days', type=int, default=None,
+                           help='Only keep the last DAYS days of plays '
+                           '(default: the widest playlist window plus {})'
+                           .format(MARGIN_DAYS))
+    exportCmd.add_argument('--all', action='store_true',
+                           help='Keep every stored day')
+    importCmd = commands.add_parser('import', help='Restore a snapshot')
+    importCmd.add_argument('path', help='Snapshot file to read')
+    return parser.parse_args()
+
+
+def main():
+    args = parseArgs()
+    config = {}
+    if os.path.exists(args.config):
+        with open(args.config, 'r', encoding='utf-8') as inCfg:
+            config = json.load(inCfg)
+
+    try:
+        if args.command == 'export':
+            days = args.days
+            if days is None and not args.all:
+                days = widestWindow(config, playlistSpecs(config))[
+                    'daysToParse'] + MARGIN_DAYS
+            manifest = exportSnapshot(config, args.path, days)
+            uprint('Wrote {} ({} .. {}, {} bytes)'.format(
+                args.path, manifest['first'], manifest['last'],
+                os.path.getsize(args.path)))
+        else:
+            manifest = importSnapshot(config, args.path)
+            uprint('Imported {} ({} .. {})'.format(
+                args.path, manifest['first'], manifest['last']))
+    except (SnapshotError, zipfile.BadZipFile) as e:
+        uprint('Snapshot error: {}'.format(e))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
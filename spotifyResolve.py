@@ -0,0 +1,264 @@
+import os
+import re
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from difflib import SequenceMatcher
+
+import requests
+from requests.adapters import HTTPAdapter
+from spotipy.exceptions import SpotifyException
+from urllib3.util.retry import Retry
+
+from metrics import metrics
+from normalize import cleanSong, normalizeArtist, normalizeTitle
+
+# Status codes urllib3 should retry internally. 429 is left out so that it
+# surfaces here with its Retry-After header and every worker can back off
+# together.
+STATUS_FORCELIST = (500, 502, 503, 504)
+
+# Candidates fetched per search, and the similarity (0..1) of both artist
+# and title the best one needs to be accepted.
+MATCH_LIMIT = 20
+MATCH_THRESHOLD = 0.8
+
+# Resolutions stored in the cache between commits, so a pass that dies
+# halfway doesn't search again for what it had already resolved.
+COMMIT_EVERY = 50
+
+NUMBER = re.compile(r'\d+')
+
+
+def spotifySession(maxWorkers=4):
+    # Session for spotipy.Spotify(requests_session=...). spotipy's own
+    # session lets urllib3 sleep on Retry-After per thread and then raises
+    # a 429 without the header, so build one that passes 429s straight
+    # through, with a connection pool sized for the search workers.
+    retry = Retry(total=3, connect=None, read=False,
+                  allowed_methods=frozenset(['GET', 'POST', 'PUT', 'DELETE']),
+                  status=3, backoff_factor=0.3,
+                  status_forcelist=STATUS_FORCELIST,
+                  respect_retry_after_header=False)
+    adapter = HTTPAdapter(max_retries=retry, pool_connections=maxWorkers,
+                          pool_maxsize=maxWorkers)
+    session = metrics.instrument(requests.Session())
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+class RateGate:
+    # Shared pause for all search workers. A 429 on any thread closes the
+    # gate until Retry-After has elapsed.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.until = 0.0
+
+    def pause(self, seconds):
+        with self.lock:
+            self.until = max(self.until, time.monotonic() + seconds)
+
+    def wait(self):
+        while True:
+            with self.lock:
+                delay = self.until - time.monotonic()
+            if delay <= 0:
+                return
+            time.sleep(delay)
+
+
+def retryAfter(err, attempt):
+    headers = getattr(err, 'headers', None) or {}
+    value = headers.get('Retry-After') or headers.get('retry-after')
+    try:
+        return max(float(value), 0.0)
+    except (TypeError, ValueError):
+        return float(2 ** attempt)
+
+
+def search(sp, query, gate, maxRetries=5, limit=10):
+    attempt = 0
+    while True:
+        gate.wait()
+        metrics.count('spotify.search')
+        try:
+            return sp.search(query, limit=limit)
+        except SpotifyException as e:
+            if e.http_status == 429:
+                metrics.count('spotify.429')
+            if e.http_status != 429 or attempt >= maxRetries:
+                raise
+            metrics.count('spotify.retries')
+            gate.pause(retryAfter(e, attempt))
+            attempt += 1
+
+
+def exactQuery(artist, song):
+    return "artist:{} track:{}".format(artist, song)
+
+
+def keywordQuery(artist, song):
+    a_scrub = artist
+    if 'feat.' in a_scrub.lower():
+        a_scrub = a_scrub[:a_scrub.lower().index('feat.')]
+    a_scrub = a_scrub.replace('&', '')
+    s_scrub = song.replace('&', '')
+    return "{} {}".format(a_scrub, s_scrub)
+
+
+def similarity(a, b):
+    if a == b:
+        return 1.0
+    return SequenceMatcher(None, a, b).ratio()
+
+
+def titleSimilarity(a, b):
+    # Titles that differ only in a number ("Revolution 1" and "Revolution
+    # 9", "Untitled #1" and "Untitled #4") are different songs, however
+    # close the rest of the title is.
+    if NUMBER.findall(a) != NUMBER.findall(b):
+        return 0.0
+    return similarity(a, b)
+
+
+def scoreCandidate(artist, song, item):
+    # The weaker of the artist and title similarities, so a cover (right
+    # title) or another song by the artist (right artist) can't pass on
+    # one half alone. A KEXP artist like "A & B" is compared against each
+    # credited artist and all of them together.
+    names = [normalizeArtist(a['name']) for a in item['artists']]
+    artistScore = max(similarity(artist, n)
+                      for n in names + [' and '.join(names)])
+    return min(artistScore,
+               titleSimilarity(song, normalizeTitle(item['name'])))
+
+
+def bestMatch(artist, song, items, threshold=MATCH_THRESHOLD):
+    # The highest scoring candidate, earliest first on ties, or None if
+    # nothing reaches `threshold`.
+    artist = normalizeArtist(artist)
+    song = normalizeTitle(song)
+    best, bestScore = None, threshold
+    for item in items:
+        if item is None or len(item['artists']) == 0:
+            continue
+        score = scoreCandidate(artist, song, item)
+        if score > bestScore or (best is None and score == bestScore):
+            best, bestScore = item, score
+    return best, bestScore
+
+
+def resolveSong(sp, artist, song, gate, limit=MATCH_LIMIT,
+                threshold=MATCH_THRESHOLD):
+    # One keyword search for up to `limit` candidates, scored locally
+    # against the artist and title. Returns a dict describing what was
+    # found, never raises.
+    s = cleanSong(song)
+    query = keywordQuery(artist, s)
+    resolved = {'artist': artist, 'song': song, 'query': query,
+                'id': None, 'path': None, 'error': None}
+    try:
+        items = search(sp, query, gate, limit=limit)['tracks']['items']
+        best, score = bestMatch(artist, s, items, threshold)
+        if best is not None:
+            resolved.update(id=best['id'], path='match', score=score,
+                            found=(best['artists'][0]['name'],
+                                   best['name']))
+    except Exception as e:
+        resolved['error'] = e
+    return resolved
+
+
+class ResolutionCache:
+    # Durable (artist, track) -> Spotify ID map. Hits remember which search
+    # path found them; misses ("no fallback result either") are kept as
+    # negative entries and retried once they are older than `negativeTTL`
+    # seconds. Failed searches are never stored.
+    def __init__(self, path='cache/resolve.sqlite', negativeTTL=7*86400):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.negativeTTL = negativeTTL
+        self.db = sqlite3.connect(path)
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS resolution ('
+            ' artist TEXT NOT NULL,'
+            ' track TEXT NOT NULL,'
+            ' track_id TEXT,'
+            ' path TEXT,'
+            ' found_artist TEXT,'
+            ' found_track TEXT,'
+            ' resolved_at REAL NOT NULL,'
+            ' PRIMARY KEY (artist, track))')
+        self.db.commit()
+
+    @classmethod
+    def fromConfig(cls, config):
+        return cls(config.get('resolveCache', 'cache/resolve.sqlite'),
+                   config.get('negativeCacheDays', 7) * 86400)
+
+    @staticmethod
+    def key(artist, song):
+        return artist.strip(), cleanSong(song)
+
+    def get(self, artist, song):
+        row = self.db.execute(
+            'SELECT track_id, path, found_artist, found_track, resolved_at'
+            ' FROM resolution WHERE artist=? AND track=?',
+            self.key(artist, song)).fetchone()
+        if row is None:
+            return None
+        trackId, path, foundArtist, foundTrack, resolvedAt = row
+        if trackId is None and time.time() - resolvedAt > self.negativeTTL:
+            return None
+        resolved = {'artist': artist, 'song': song,
+                    'query': exactQuery(*self.key(artist, song)),
+                    'id': trackId, 'path': path, 'error': None,
+                    'cached': True}
+        if path != 'exact':
+            resolved['query'] = keywordQuery(*self.key(artist, song))
+        if path in ('keyword', 'match'):
+            resolved['found'] = (foundArtist, foundTrack)
+        return resolved
+
+    def put(self, resolved):
+        if resolved['error'] is not None:
+            return
+        found = resolved.get('found', (None, None))
+        self.db.execute(
+            'INSERT OR REPLACE INTO resolution VALUES (?,?,?,?,?,?,?)',
+            self.key(resolved['artist'], resolved['song']) +
+            (resolved['id'], resolved['path'], found[0], found[1],
+             time.time()))
+
+    def commit(self):
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+
+def resolveSongs(sp, songs, maxWorkers=4, cache=None, limit=MATCH_LIMIT,
+                 threshold=MATCH_THRESHOLD):
+    # Resolves (artist, song) pairs with bounded concurrency. Results come
+    # back in the same order as `songs`. With a cache, only pairs it can't
+    # answer are searched, and their outcomes are stored for next time.
+    results = [cache.get(a, s) if cache is not None else None
+               for a, s in songs]
+    todo = [i for i, r in enumerate(results) if r is None]
+    if cache is not None:
+        metrics.count('cache.search.hits', len(songs) - len(todo))
+        metrics.count('cache.search.misses', len(todo))
+    gate = RateGate()
+    with ThreadPoolExecutor(max_workers=maxWorkers) as pool:
+        fresh = pool.map(lambda i: resolveSong(sp, *songs[i], gate, limit,
+                                               threshold), todo)
+        for n, (i, resolved) in enumerate(zip(todo, fresh), 1):
+            results[i] = resolved
+            if cache is not None:
+                cache.put(resolved)
+                if n % COMMIT_EVERY == 0:
+                    cache.commit()
+    if cache is not None:
+        cache.commit()
+    return results
@@ -0,0 +1,211 @@
+import argparse
+import datetime
+import hashlib
+import json
+import os
+import shutil
+import sys
+
+from metrics import metrics
+from processCatalog import (aggregateSpecs, collectTrackIds, findPlaylists,
+                            groupSpecs, playlistSpecs, pushPlaylist,
+                            rankSpecs, resolveRanking, setEnvironment,
+                            spotifyClient, uprint)
+
+# The weekly run as resumable stages. Each stage's output is written to
+# the job directory (jobDir in the config, default job/) atomically when
+# the stage completes, and a rerun skips every stage that has its output:
+#
+#   ranking.json  ranked groups of every playlist (fetch + aggregate + rank)
+#   tracks.json   playlist id and resolved track ids of every playlist
+#   push.json     journal of the playlist updates: per playlist, whether
+#                 the diff sync and the description went through, or with
+#                 syncMode replace how many 100-track chunks were applied
+#
+#   python weeklyJob.py            # runs or resumes today's job
+#   python weeklyJob.py --fresh    # starts over
+#
+# A job belongs to one day and one set of playlist specs; a run on a later
+# day or with changed specs discards the outputs of the old one.
+
+STAGES = ('ranking', 'tracks', 'push')
+
+
+def writeJson(path, data):
+    # Write to a temporary file next to `path`, flush it to disk and rename
+    # it into place, so `path` holds either the old or the new contents.
+    partial = path + '.partial'
+    with open(partial, 'w', encoding='utf-8') as outJson:
+        json.dump(data, outJson, indent=1, ensure_ascii=False)
+        outJson.flush()
+        os.fsync(outJson.fileno())
+    os.replace(partial, path)
+
+
+def jobKey(specs):
+    today = datetime.datetime.utcnow().strftime('%Y-%m-%d')
+    return '{}-{}'.format(today, hashlib.sha256(json.dumps(
+        specs, sort_keys=True).encode('utf-8')).hexdigest()[:12])
+
+
+class JobState:
+    # Stage outputs of one job, as <stage>.json files in `path`.
+    def __init__(self, path, key, fresh=False):
+        self.path = path
+        self.key = key
+        stored = self.load('job')
+        if fresh or stored is None or stored.get('key') != key:
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            os.makedirs(path)
+            self.save('job', {'key': key})
+        else:
+            uprint('Resuming job {}: {}'.format(key, ', '.join(
+                s for s in STAGES if self.has(s)) or 'no stage done'))
+
+    @classmethod
+    def fromConfig(cls, config, specs, fresh=False):
+        return cls(config.get('jobDir', 'job'), jobKey(specs), fresh)
+
+    def file(self, stage):
+        return os.path.join(self.path, stage + '.json')
+
+    def has(self, stage):
+        return os.path.exists(self.file(stage))
+
+    def load(self, stage):
+        if not self.has(stage):
+            return None
+        with open(self.file(stage), 'r', encoding='utf-8') as inJson:
+            return json.load(inJson)
+
+    def save(self, stage, data):
+        writeJson(self.file(stage), data)
+
+
+class PushJournal:
+    # push.json: {playlist name: {'synced': bool, 'chunks': n,
+    # 'described': bool}}, rewritten on every record().
+    def __init__(self, job):
+        self.job = job
+        self.entries = job.load('push') or {}
+
+    def playlist(self, name):
+        return JournalEntry(self, self.entries.setdefault(name, {}))
+
+    def save(self):
+        self.job.save('push', self.entries)
+
+
+class JournalEntry:
+    # The journal pushPlaylist works with, for one playlist.
+    def __init__(self, journal, entry):
+        self.journal = journal
+        self.entry = entry
+
+    def record(self, **steps):
+        self.entry.update(steps)
+        self.journal.save()
+
+
+def runJob(config, specs, fresh=False):
+    job = JobState.fromConfig(config, specs, fresh)
+
+    ranking = job.load('ranking')
+    if ranking is None:
+        if config.get('stream'):
+            results = groupSpecs(config, specs)
+        else:
+            results = aggregateSpecs(config, specs)
+        ranking = rankSpecs(specs, results)
+        job.save('ranking', ranking)
+        uprint('Stage ranking done')
+
+    sp = None
+    tracks = job.load('tracks')
+    if tracks is None:
+        sp = loginOrExit(config)
+        pl_ids = findPlaylists(config, sp, specs)
+        resolved = resolveRanking(config, sp, ranking)
+        failed = [r for r in resolved.values() if r['error'] is not None]
+        if failed:
+            # Saving now would drop these songs from the playlists until the
+            # next job, so fail the run; the resolutions that went through
+            # are cached and a rerun only searches for the rest.
+            uprint('{} of {} searches failed, first: {}'.format(
+                len(failed), len(resolved), failed[0]['error']))
+            sys.exit(1)
+        tracks = []
+        for spec, entry in zip(specs, ranking):
+            uprint('== {} =='.format(spec['playlist_name']))
+            tracks.append({
+                'playlist_name': spec['playlist_name'],
+                'playlist_id': pl_ids[spec['playlist_name']],
+                'track_ids': collectTrackIds(entry['groups'], resolved)})
+        job.save('tracks', tracks)
+        uprint('Stage tracks done')
+
+    journal = PushJournal(job)
+    for spec, entry in zip(specs, tracks):
+        done = journal.entries.get(entry['playlist_name'], {})
+        if done.get('described') and (done.get('synced') or
+                                      done.get('chunks', 0) * 100 >=
+                                      len(entry['track_ids'])):
+            uprint('{} already updated'.format(entry['playlist_name']))
+            continue
+        sp = sp or loginOrExit(config)
+        pushPlaylist(config, sp, spec, entry['playlist_id'],
+                     entry['track_ids'],
+                     journal.playlist(entry['playlist_name']))
+    if not config.get('dryRun'):
+        uprint('Stage push done')
+
+
+def loginOrExit(config):
+    # A missing token fails the run (rather than finishing quietly, as
+    # processCatalog does) so the job is retried and resumes here.
+    sp = spotifyClient(config)
+    if sp is None:
+        uprint("Can't get token for", config['spotify_username'])
+        sys.exit(1)
+    return sp
+
+
+def parseArgs():
+    parser = argparse.ArgumentParser(
+        'Run the weekly KEXP playlist update as resumable stages')
+    parser.add_argument('--config', type=str, default='config.json',
+                        help='Config file in json format')
+    parser.add_argument('--fresh', action='store_true',
+                        help='Discard the outputs of an earlier run of the '
+                        'job and start over')
+    parser.add_argument('--stream', action='store_true',
+                        help='Stream plays into the grouping (see '
+                        'processCatalog.py --stream)')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='Report the planned playlist changes without '
+                        'applying or journaling them')
+    parser.add_argument('--metrics', type=str, default=None,
+                        help='Write the JSON metrics summary to this file '
+                        'instead of stdout')
+    return parser.parse_args()
+
+
+def main():
+    args = parseArgs()
+    with open(args.config, 'r', encoding='utf-8') as inCfg:
+        config = json.load(inCfg)
+
+    if args.stream:
+        config['stream'] = True
+    if args.dry_run:
+        config['dryRun'] = True
+
+    setEnvironment(config)
+    with metrics.stage('total'):
+        runJob(config, playlistSpecs(config), args.fresh)
+    metrics.write(args.metrics)
+
+
+if __name__ == "__main__":
+    main()